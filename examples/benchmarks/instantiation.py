@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+import pddlstream.algorithms.instantiation as instantiation
+from pddlstream.algorithms.common import evaluations_from_init
+from pddlstream.algorithms.instantiation import Instantiator
+from pddlstream.language.generator import from_test
+from pddlstream.language.stream import Stream, StreamInfo
+
+# Compares the semi-naive hash join (JOIN_DOMAINS=True) against the cartesian product
+# for streams whose domains have several conditions over a large number of facts
+
+def get_streams():
+    test_fn = from_test(lambda *args: True)
+    return [
+        Stream('path', test_fn, ['?a', '?b', '?c'],
+               [('edge', '?a', '?b'), ('edge', '?b', '?c')],
+               [], [('path', '?a', '?c')], StreamInfo()),
+        Stream('triangle', test_fn, ['?a', '?b', '?c'],
+               [('edge', '?a', '?b'), ('edge', '?b', '?c'), ('edge', '?c', '?a')],
+               [], [('triangle', '?a', '?b', '?c')], StreamInfo()),
+        Stream('colored', test_fn, ['?a', '?b', '?k'],
+               [('edge', '?a', '?b'), ('color', '?a', '?k'), ('color', '?b', '?k'), ('vertex', '?a')],
+               [], [('same', '?a', '?b')], StreamInfo()),
+    ]
+
+def get_init(num_vertices, num_edges, num_colors, seed=0):
+    random.seed(seed)
+    init = [('vertex', v) for v in range(num_vertices)]
+    init.extend(('color', v, random.randint(0, num_colors - 1)) for v in range(num_vertices))
+    edges = set()
+    while len(edges) < num_edges:
+        edges.add(tuple(random.sample(range(num_vertices), 2)))
+    init.extend(('edge', v1, v2) for v1, v2 in sorted(edges))
+    return init
+
+def instantiate(streams, evaluations, join):
+    instantiation.JOIN_DOMAINS = join
+    start_time = time.time()
+    instantiator = Instantiator(streams, evaluations)
+    instances = set()
+    while instantiator:
+        instances.add(instantiator.pop_stream())
+    runtime = time.time() - start_time
+    return instances, runtime
+
+##################################################
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--vertices', default=30, type=int, help='The number of vertices')
+    parser.add_argument('-e', '--edges', default=90, type=int, help='The number of edges')
+    parser.add_argument('-c', '--colors', default=4, type=int, help='The number of colors')
+    args = parser.parse_args()
+    print('Arguments:', args)
+
+    streams = get_streams()
+    evaluations = evaluations_from_init(get_init(args.vertices, args.edges, args.colors))
+    product_instances, product_time = instantiate(streams, evaluations, join=False)
+    join_instances, join_time = instantiate(streams, evaluations, join=True)
+    assert join_instances == product_instances
+    print('Facts: {} | Instances: {} | Product: {:.3f}s | Join: {:.3f}s | Speedup: {:.1f}x'.format(
+        len(evaluations), len(join_instances), product_time, join_time, product_time / max(join_time, 1e-6)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import gc
+import resource
+import sys
+
+from pddlstream.algorithms.common import evaluations_from_init, SolutionStore
+from pddlstream.algorithms.context import SolverContext
+from pddlstream.algorithms.skeleton import SkeletonQueue
+from pddlstream.language.function import Function, FunctionInfo
+from pddlstream.language.generator import from_fn
+from pddlstream.language.object import Object, OptimisticObject, UniqueOptValue
+from pddlstream.language.stream import Stream, StreamInfo
+from pddlstream.utils import INF
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+# Reports the bytes per instance of the solver objects that use __slots__ (compared to an equivalent __dict__ layout)
+# and the memory used by a focused solve of examples.continuous_tamp
+
+class DictLayout(object):
+    pass
+
+def get_slots(cls):
+    return [name for c in cls.__mro__ for name in getattr(c, '__slots__', ()) if name != '__weakref__']
+
+def get_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def get_dict_size(obj):
+    copy = DictLayout()
+    copy.__dict__.update({name: getattr(obj, name) for name in get_slots(type(obj)) if hasattr(obj, name)})
+    return get_size(copy)
+
+def get_rss():
+    # Peak resident set size in megabytes (ru_maxrss is in kilobytes on Linux and bytes on macOS)
+    scale = 1024.**2 if sys.platform == 'darwin' else 1024.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+##################################################
+
+def get_examples():
+    stream = Stream('sample', from_fn(lambda x: (x + 1,)), ['?x'], [('conf', '?x')],
+                    ['?y'], [('conf', '?y'), ('motion', '?x', '?y')], StreamInfo())
+    function = Function(('distance', '?x'), lambda x: 1, [('conf', '?x')], FunctionInfo())
+    obj = Object.from_value(0)
+    stream_instance = stream.get_instance([obj])
+    stream_result = stream_instance.get_result([Object.from_value(1)], optimistic=False)
+    opt_obj = OptimisticObject.from_opt(1, UniqueOptValue(stream_instance, 0, 0))
+    function_instance = function.get_instance([obj])
+    function_result = function_instance._Result(function_instance, 1, optimistic=False)
+    store = SolutionStore(evaluations_from_init([]), max_time=INF, success_cost=INF, verbose=False)
+    queue = SkeletonQueue(store, domain=None)
+    queue.new_skeleton([stream_result], [], cost=0)
+    [skeleton] = queue.skeletons
+    return [obj, opt_obj, stream_instance, stream_result, function_instance, function_result,
+            skeleton, skeleton.root]
+
+def report_layouts():
+    print('{:<20} {:>8} {:>8}'.format('Class', 'Slots', 'Dict'))
+    for obj in get_examples():
+        print('{:<20} {:>8} {:>8}'.format(type(obj).__name__, get_size(obj), get_dict_size(obj)))
+
+def report_solve(problem_name, num_blocks, max_time):
+    from examples.continuous_tamp.primitives import PROBLEMS, MOVE_COST
+    from examples.continuous_tamp.run import pddlstream_from_tamp
+    from pddlstream.algorithms.focused import solve_focused
+
+    problem_fn = {fn.__name__: fn for fn in PROBLEMS}[problem_name]
+    stream_info = {
+        't-region': StreamInfo(eager=False, p_success=0),
+        't-cfree': StreamInfo(eager=False, negate=True),
+        'distance': FunctionInfo(opt_fn=lambda q1, q2: MOVE_COST),
+    }
+    gc.collect()
+    start_rss = get_rss()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    with SolverContext() as context:
+        solution = solve_focused(pddlstream_from_tamp(problem_fn(num_blocks)), stream_info=stream_info,
+                                 planner='max-astar', max_time=max_time, verbose=False)
+        registry = context.registry
+        print('Solved: {} | Objects: {} | Optimistic: {}'.format(
+            solution[0] is not None, registry.num_objects, registry.num_optimistic))
+        context.destroy()
+    if tracemalloc is not None:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('Peak traced: {:.1f} MB'.format(peak / 1024.**2))
+    print('Peak RSS: {:.1f} MB (+{:.1f} MB)'.format(get_rss(), get_rss() - start_rss))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--problem', default='blocked', help='The name of the continuous_tamp problem')
+    parser.add_argument('-n', '--number', default=2, type=int, help='The number of blocks')
+    parser.add_argument('-t', '--max_time', default=30, type=int, help='The max time')
+    args = parser.parse_args()
+    print('Arguments:', args)
+    report_layouts()
+    report_solve(args.problem, args.number, args.max_time)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from collections import Counter
 
-from pddlstream.algorithms.common import evaluations_from_init, SOLUTIONS
+from pddlstream.algorithms.common import evaluations_from_init
+from pddlstream.algorithms.context import get_context
 from pddlstream.algorithms.constraints import add_plan_constraints
 from pddlstream.algorithms.downward import parse_lisp, parse_goal, make_cost, set_cost_scale, \
     fd_from_fact, get_conjunctive_parts, get_disjunctive_parts, Domain
@@ -73,10 +74,8 @@ def set_unit_costs(domain):
         action.cost = make_cost(1)
 
 def reset_globals():
-    # TODO: maintain these dictionaries in an object
-    Object.reset()
-    OptimisticObject.reset()
-    SOLUTIONS[:] = []
+    # Only resets the active SolverContext
+    get_context().release()
 
 def parse_problem(problem, stream_info={}, constraints=None, unit_costs=False, unit_efforts=False):
     # TODO: just return the problem if already written programmatically
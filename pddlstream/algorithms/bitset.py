@@ -0,0 +1,170 @@
+# Propositional states stored as Python int bitsets over an AtomIndex
+# Operators are compiled into (positive, negative) condition masks so that applicability checks and
+# progression are a few integer operations rather than one hash lookup (and Atom construction) per literal
+
+class AtomIndex(object):
+    """
+    Assigns each atom a bit on demand.
+    Literals are additionally cached so that checking a NegatedAtom does not construct its positive Atom,
+    and operators are compiled once per index.
+    """
+    def __init__(self, atoms=[]):
+        self.atoms = []
+        self.bit_from_atom = {}
+        self.bit_from_literal = {} # literal -> (bit, negated)
+        self.compiled_from_id = {} # id(operator) -> BitAction (PropositionalAxioms are unhashable)
+        self.encode(atoms)
+    def get_bit(self, atom):
+        bit = self.bit_from_atom.get(atom)
+        if bit is None:
+            bit = self.bit_from_atom[atom] = 1 << len(self.atoms)
+            self.atoms.append(atom)
+        return bit
+    def get_literal(self, literal):
+        entry = self.bit_from_literal.get(literal)
+        if entry is None:
+            entry = self.bit_from_literal[literal] = (self.get_bit(literal.positive()), literal.negated)
+        return entry
+    def get_masks(self, literals):
+        positive = negative = 0
+        for literal in literals:
+            bit, negated = self.get_literal(literal)
+            if negated:
+                negative |= bit
+            else:
+                positive |= bit
+        return positive, negative
+    def encode(self, atoms):
+        bits = 0
+        for atom in atoms:
+            bits |= self.get_bit(atom)
+        return bits
+    def decode(self, bits):
+        atoms = []
+        while bits:
+            lowest = bits & -bits
+            atoms.append(self.atoms[lowest.bit_length() - 1])
+            bits ^= lowest
+        return atoms
+    def compile(self, operator):
+        # The BitAction references operator, so its id is not reused while cached
+        compiled = self.compiled_from_id.get(id(operator))
+        if compiled is None:
+            compiled = self.compiled_from_id[id(operator)] = BitAction(self, operator)
+        return compiled
+    def __len__(self):
+        return len(self.atoms)
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, len(self))
+
+def masks_hold(bits, masks):
+    positive, negative = masks
+    return ((bits & positive) == positive) and not (bits & negative)
+
+##################################################
+
+class BitAction(object):
+    """
+    A pddl.PropositionalAction or pddl.PropositionalAxiom compiled against an AtomIndex.
+    AtomIndex.compile caches it, so the operator must not be modified after it is first applied or checked.
+    """
+    def __init__(self, index, action):
+        self.action = action
+        if hasattr(action, 'condition'): # PropositionalAxiom
+            self.precondition = index.get_masks(action.condition)
+            bit, negated = index.get_literal(action.effect)
+            self.del_effects = [((0, 0), bit)] if negated else []
+            self.add_effects = [] if negated else [((0, 0), bit)]
+        else:
+            self.precondition = index.get_masks(action.precondition)
+            self.del_effects = [(index.get_masks(conditions), index.get_bit(effect))
+                                for conditions, effect in action.del_effects]
+            self.add_effects = [(index.get_masks(conditions), index.get_bit(effect))
+                                for conditions, effect in action.add_effects]
+        self.conditional = any(masks != (0, 0) for masks, _ in self.del_effects + self.add_effects)
+        self.del_mask = 0
+        for _, bit in self.del_effects:
+            self.del_mask |= bit
+        self.add_mask = 0
+        for _, bit in self.add_effects:
+            self.add_mask |= bit
+    def is_applicable(self, bits):
+        return masks_hold(bits, self.precondition)
+    def apply(self, bits):
+        if not self.conditional:
+            return (bits & ~self.del_mask) | self.add_mask
+        # Same sequential semantics as downward.apply_action
+        for masks, bit in self.del_effects:
+            if masks_hold(bits, masks):
+                bits &= ~bit
+        for masks, bit in self.add_effects:
+            if masks_hold(bits, masks):
+                bits |= bit
+        return bits
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.action.name)
+
+##################################################
+
+class BitState(object):
+    """
+    A mutable set of atoms represented as an int over an AtomIndex.
+    Supports the set operations used by the scheduling code, so it can be passed wherever a state set is.
+    """
+    def __init__(self, index, atoms=[]):
+        self.index = index
+        self.bits = index.encode(atoms)
+    @staticmethod
+    def from_bits(index, bits):
+        state = BitState(index)
+        state.bits = bits
+        return state
+    def copy(self):
+        return BitState.from_bits(self.index, self.bits)
+    def literal_holds(self, literal):
+        bit, negated = self.index.get_literal(literal)
+        return bool(self.bits & bit) != negated
+    def conditions_hold(self, conditions):
+        return masks_hold(self.bits, self.index.get_masks(conditions))
+    def is_applicable(self, action):
+        if not isinstance(action, BitAction):
+            action = self.index.compile(action)
+        return action.is_applicable(self.bits)
+    def apply_action(self, action):
+        if not isinstance(action, BitAction):
+            action = self.index.compile(action)
+        self.bits = action.apply(self.bits)
+    def add(self, atom):
+        self.bits |= self.index.get_bit(atom)
+    def discard(self, atom):
+        bit = self.index.bit_from_atom.get(atom)
+        if bit is not None:
+            self.bits &= ~bit
+    def update(self, atoms):
+        if isinstance(atoms, BitState) and (atoms.index is self.index):
+            self.bits |= atoms.bits
+        else:
+            self.bits |= self.index.encode(atoms)
+    def __or__(self, atoms):
+        state = self.copy()
+        state.update(atoms)
+        return state
+    __ror__ = __or__
+    def __rsub__(self, atoms):
+        return {atom for atom in atoms if atom not in self}
+    def __contains__(self, atom):
+        bit = self.index.bit_from_atom.get(atom)
+        return (bit is not None) and bool(self.bits & bit)
+    def __iter__(self):
+        return iter(self.index.decode(self.bits))
+    def __len__(self):
+        return bin(self.bits).count('1')
+    def __eq__(self, other):
+        if isinstance(other, BitState) and (other.index is self.index):
+            return self.bits == other.bits
+        return set(self) == set(other)
+    def __ne__(self, other):
+        return not self == other
+    __hash__ = None
+    def __repr__(self):
+        return '{}{}'.format(self.__class__.__name__, set(self))
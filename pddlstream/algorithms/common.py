@@ -1,6 +1,7 @@
 import time
 from collections import namedtuple, OrderedDict
 
+from pddlstream.algorithms.context import get_context, DEFAULT_CONTEXT
 from pddlstream.language.constants import is_plan
 from pddlstream.language.conversion import evaluation_from_fact, obj_from_value_expression, revert_solution
 from pddlstream.utils import INF, elapsed_time
@@ -19,7 +20,7 @@ INTERNAL_EVALUATION = False
 EvaluationNode = namedtuple('EvaluationNode', ['complexity', 'result'])
 Solution = namedtuple('Solution', ['plan', 'cost', 'time'])
 
-SOLUTIONS = []
+SOLUTIONS = DEFAULT_CONTEXT.solutions # Other contexts record their solutions on the context itself
 
 class SolutionStore(object):
     def __init__(self, evaluations, max_time, success_cost, verbose):
@@ -50,6 +51,8 @@ class SolutionStore(object):
         return self.has_solution() and (self.best_cost <= self.success_cost)
     def elapsed_time(self):
         return elapsed_time(self.start_time)
+    def time_remaining(self):
+        return self.max_time - self.elapsed_time()
     def is_timeout(self):
         return self.max_time <= self.elapsed_time()
     def is_terminated(self):
@@ -57,11 +60,65 @@ class SolutionStore(object):
     #def __repr__(self):
     #    raise NotImplementedError()
     def extract_solution(self):
-        SOLUTIONS[:] = self.solutions
+        get_context().solutions[:] = self.solutions
         return revert_solution(self.best_plan, self.best_cost, self.evaluations)
 
 ##################################################
 
+class Evaluations(OrderedDict):
+    """
+    An OrderedDict of evaluations that also logs each evaluation added and removed.
+    Evaluations are removed when disabled instances are reenabled, so consumers that are maintained
+    across iterations track changes through an EvaluationCursor rather than a position.
+    """
+    def __init__(self, *args, **kwargs):
+        self.added = []
+        self.removed = []
+        super(Evaluations, self).__init__(*args, **kwargs)
+    def __setitem__(self, evaluation, node, *args, **kwargs):
+        if evaluation not in self:
+            self.added.append(evaluation)
+        super(Evaluations, self).__setitem__(evaluation, node, *args, **kwargs)
+    def __delitem__(self, evaluation, *args, **kwargs):
+        super(Evaluations, self).__delitem__(evaluation, *args, **kwargs)
+        self.removed.append(evaluation)
+    def pop(self, evaluation, *args, **kwargs):
+        if evaluation in self:
+            self.removed.append(evaluation) # May be logged twice if pop calls __delitem__
+        return super(Evaluations, self).pop(evaluation, *args, **kwargs)
+    def popitem(self, *args, **kwargs):
+        evaluation, node = super(Evaluations, self).popitem(*args, **kwargs)
+        self.removed.append(evaluation)
+        return evaluation, node
+    def setdefault(self, evaluation, node=None):
+        if evaluation not in self:
+            self[evaluation] = node
+        return self[evaluation]
+    def clear(self):
+        self.removed.extend(self)
+        super(Evaluations, self).clear()
+    def __reduce__(self):
+        return self.__class__, (list(self.items()),)
+
+class EvaluationCursor(object):
+    # Reports the evaluations removed and added since the previous update
+    def __init__(self, evaluations):
+        assert isinstance(evaluations, Evaluations)
+        self.evaluations = evaluations
+        self.num_added = 0
+        self.num_removed = 0
+    def update(self):
+        # Removed evaluations that were added again are in both lists, so apply the removals first
+        removed = self.evaluations.removed[self.num_removed:]
+        added = self.evaluations.added[self.num_added:]
+        self.num_removed = len(self.evaluations.removed)
+        self.num_added = len(self.evaluations.added)
+        removed = list(OrderedDict.fromkeys(removed))
+        added = [evaluation for evaluation in OrderedDict.fromkeys(added) if evaluation in self.evaluations]
+        return removed, added
+
+##################################################
+
 def add_fact(evaluations, fact, result=INIT_EVALUATION, complexity=0):
     evaluation = evaluation_from_fact(fact)
     if evaluation in evaluations:
@@ -84,7 +141,7 @@ def add_certified(evaluations, result):
 
 
 def evaluations_from_init(init):
-    evaluations = OrderedDict()
+    evaluations = Evaluations()
     for raw_fact in init:
         fact = obj_from_value_expression(raw_fact)
         add_fact(evaluations, fact, result=INIT_EVALUATION, complexity=0)
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import threading
+
+from functools import wraps
+
+from pddlstream.language.object import ObjectRegistry, DEFAULT_REGISTRY
+from pddlstream.utils import safe_rm_dir
+
+# Relative to the root of a SolverContext (the current working directory for the default context)
+TEMP_DIR = 'temp/'
+VISUALIZATIONS_DIR = 'visualizations/'
+DATA_DIR = 'statistics/py{:d}/' # Shared across contexts by default so that statistics accumulate
+CACHE_DIR = 'cache/py{:d}/' # Shared across contexts by default so that stream outputs are reused (see StreamCache)
+
+class SolverContext(object):
+    """
+    The state of a single solve that would otherwise be process-global:
+    the planner working directory, the visualizations directory, the statistics and stream cache directories,
+    the Object/OptimisticObject registry, the anytime solutions, and caches of intermediate results.
+    Activating a context (with context: ...) only affects the current thread,
+    so separate threads (or processes sharing a cwd) can solve concurrently.
+    """
+    _local = threading.local()
+    def __init__(self, root=None, data_dir=DATA_DIR, cache_dir=CACHE_DIR, registry=None, clean=True):
+        self.clean = clean and (root is None) # Only remove directories this context created
+        if root is None:
+            root = tempfile.mkdtemp(prefix='pddlstream-')
+        self.root = root
+        self.temp_dir = os.path.join(self.root, TEMP_DIR)
+        self.visualizations_dir = os.path.join(self.root, VISUALIZATIONS_DIR)
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.registry = ObjectRegistry() if registry is None else registry
+        self.solutions = []
+        self.caches = {} # Intermediate results (e.g. grounding) reused within a solve (see clear_caches)
+    @staticmethod
+    def get_active():
+        stack = getattr(SolverContext._local, 'stack', None)
+        return stack[-1] if stack else DEFAULT_CONTEXT
+    def get_temp_path(self, *paths):
+        return os.path.join(self.temp_dir, *paths)
+    def get_visualization_path(self, *paths):
+        return os.path.join(self.visualizations_dir, *paths)
+    def clear_caches(self):
+        # Caches only last for a single solve (e.g. the OptimisticClosure and IncrementalModel reference
+        # its evaluations and grounding), so they are dropped (and closed if they can be) once it ends
+        caches = list(self.caches.values())
+        self.caches.clear()
+        for cache in caches:
+            if hasattr(cache, 'close'):
+                cache.close()
+        self.registry.reset_facts() # Interned facts (see conversion.get_interned)
+    def release(self):
+        # Releases the objects, solutions, and caches created by solves within this context
+        self.registry.release()
+        self.solutions[:] = []
+        self.clear_caches()
+    def destroy(self):
+        self.release()
+        if self.clean:
+            safe_rm_dir(self.root)
+    def __enter__(self):
+        if not hasattr(SolverContext._local, 'stack'):
+            SolverContext._local.stack = []
+        SolverContext._local.stack.append(self)
+        self.registry.__enter__()
+        return self
+    def __exit__(self, *args):
+        self.registry.__exit__(*args)
+        assert SolverContext._local.stack.pop() is self
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.root)
+
+DEFAULT_CONTEXT = SolverContext(root='', registry=DEFAULT_REGISTRY, clean=False)
+
+def get_context():
+    return SolverContext.get_active()
+
+def with_context(solve_fn):
+    # Adds a context keyword argument that activates a SolverContext for the duration of the call
+    # The caches of the solve are cleared when it returns
+    @wraps(solve_fn)
+    def fn(*args, **kwargs):
+        context = kwargs.pop('context', None)
+        if context is None:
+            context = get_context()
+        with context:
+            try:
+                return solve_fn(*args, **kwargs)
+            finally:
+                context.clear_caches()
+    return fn
+
+def bind_context(fn):
+    # Contexts are thread local, so fn is called within the caller's context when run by another thread
+    context = get_context()
+    @wraps(fn)
+    def context_fn(*args, **kwargs):
+        with context:
+            return fn(*args, **kwargs)
+    return context_fn
@@ -37,8 +37,7 @@ def push_disabled(instantiator, disabled):
     for instance in list(disabled):
         if instance.enumerated:
             disabled.remove(instance)
-        else:
-            # TODO: only add if not already queued
+        elif not instantiator.is_queued(instance): # The eager instantiator persists across iterations
             instantiator.push_instance(instance)
 
 def reenable_disabled(evaluations, disabled):
@@ -50,7 +49,7 @@ def process_instance(store, domain, instance, disable=True):
     if instance.enumerated:
         return []
     evaluations = store.evaluations
-    new_results, new_facts = instance.next_results(verbose=store.verbose)
+    new_results, new_facts = instance.next_results(verbose=store.verbose, max_time=store.time_remaining())
     if disable:
         instance.disable(evaluations, domain)
     for result in new_results:
@@ -1,16 +1,28 @@
 from __future__ import print_function
 
+import atexit
 import os
 import re
+import shlex
 import sys
 import subprocess
-from collections import namedtuple, defaultdict
-from time import time
-
+import tempfile
+import threading
+from collections import namedtuple, defaultdict, deque
+from time import time, sleep
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from pddlstream.algorithms.bitset import AtomIndex, BitState
+from pddlstream.algorithms.context import get_context, TEMP_DIR
 from pddlstream.language.constants import EQ, NOT, Head, Evaluation, get_prefix, get_args, OBJECT, TOTAL_COST, Action
 from pddlstream.language.conversion import is_atom, is_negated_atom, objects_from_evaluations, pddl_from_object, \
     pddl_list_from_expression, obj_from_pddl
-from pddlstream.utils import read, write, INF, clear_dir, get_file_path, MockSet, find_unique, int_ceil
+from pddlstream.utils import read, write, INF, clear_dir, get_file_path, MockSet, find_unique, int_ceil, \
+    safe_rm_dir, LRUCache, hash_content
 
 filepath = os.path.abspath(__file__)
 if ' ' in filepath:
@@ -21,16 +33,31 @@ CERBERUS_PATH = '/home/caelan/Programs/fd-redblack-ipc2018' # Check if this path
 FD_PATH = get_file_path(__file__, '../../FastDownward/')
 USE_CERBERUS = False
 
+BUILD_ERROR = 'Please compile FastDownward first [.../pddlstream$ ./FastDownward/build.py]'
+
 def find_build(fd_path):
     for release in ['release64', 'release32']:  # TODO: list the directory
         path = os.path.join(fd_path, 'builds/{}/'.format(release))
         if os.path.exists(path):
             return path
     # TODO: could also just automatically compile
-    raise RuntimeError('Please compile FastDownward first [.../pddlstream$ ./FastDownward/build.py]')
+    return None
+
+def find_translate(fd_path):
+    build_path = find_build(fd_path)
+    if build_path is not None:
+        return os.path.join(build_path, 'bin/translate')
+    source_path = os.path.join(fd_path, 'src/translate/') # The translator is pure Python
+    if os.path.exists(source_path):
+        return source_path
+    raise RuntimeError(BUILD_ERROR)
+
+TRANSLATE_PATH = find_translate(FD_PATH)
+FD_BUILD = find_build(CERBERUS_PATH if USE_CERBERUS else FD_PATH)
+FD_BIN = None if FD_BUILD is None else os.path.join(FD_BUILD, 'bin') # Only in-process search without a build
 
-TRANSLATE_PATH = os.path.join(find_build(FD_PATH), 'bin/translate')
-FD_BIN = os.path.join(find_build(CERBERUS_PATH if USE_CERBERUS else FD_PATH), 'bin')
+def has_fd_build():
+    return FD_BIN is not None
 
 DOMAIN_INPUT = 'domain.pddl'
 PROBLEM_INPUT = 'problem.pddl'
@@ -50,10 +77,10 @@ from pddl_parser.parsing_functions import parse_domain_pddl, parse_task_pddl, \
     parse_condition, check_for_duplicates
 sys.argv = original_argv
 
-TEMP_DIR = 'temp/'
 TRANSLATE_OUTPUT = 'output.sas'
 SEARCH_OUTPUT = 'sas_plan'
-SEARCH_COMMAND = 'downward --internal-plan-file {} {} < {}'
+SEARCH_BINARY = 'downward'
+PRESTART_SEARCH = True # Keeps an idle search process ready for the next call with the same configuration
 INFINITY = 'infinity'
 GOAL_NAME = '@goal' # @goal-reachable
 
@@ -124,6 +151,10 @@ if USE_CERBERUS:
 # TODO: throw a warning if max_planner_time is met
 DEFAULT_MAX_TIME = 30 # INF
 DEFAULT_PLANNER = 'ff-astar'
+# A planner can also be a portfolio: a list of SEARCH_OPTIONS names that are run concurrently
+PORTFOLIO_TIME = None # None: return the first plan found | float: return the best plan found within this time
+STREAM_PLANS = False # Return the first plan as soon as it is written (later anytime plans are not searched for)
+PLAN_POLL_PERIOD = 1e-2 # Seconds between checks for new plan files
 
 ##################################################
 
@@ -147,8 +178,25 @@ set_cost_scale(1000) # TODO: make unit costs be equivalent to cost scale = 0
 
 ##################################################
 
+CACHE_PDDL = True # Caches parsing and normalization results keyed by PDDL content
+MAX_CACHED_PDDL = 32
+MAX_NORMALIZED_OPERATORS = 10000
+
+LISP_CACHE = LRUCache(max_size=MAX_CACHED_PDDL)
+
+def copy_lisp(lisp_list):
+    if isinstance(lisp_list, list):
+        return list(map(copy_lisp, lisp_list))
+    return lisp_list
+
 def parse_lisp(lisp):
-    return pddl_parser.lisp_parser.parse_nested_list(lisp.splitlines())
+    if not CACHE_PDDL:
+        return pddl_parser.lisp_parser.parse_nested_list(lisp.splitlines())
+    key = hash_content(lisp)
+    lisp_list = LISP_CACHE.get(key)
+    if lisp_list is None:
+        lisp_list = LISP_CACHE[key] = pddl_parser.lisp_parser.parse_nested_list(lisp.splitlines())
+    return copy_lisp(lisp_list) # Cheaper than parsing and the cached copy is never exposed
 
 # TODO: dynamically generate type_dict and predicate_dict
 Domain = namedtuple('Domain', ['name', 'requirements', 'types', 'type_dict', 'constants',
@@ -268,10 +316,27 @@ def task_from_domain_problem(domain, problem):
     task = pddl.Task(domain.name, task_name, requirements, domain.types, objects,
                      domain.predicates, domain.functions, init, goal,
                      domain.actions, domain.axioms, use_metric)
-    normalize.normalize(task)
+    normalize_task(task)
     # task.add_axiom
     return task
 
+# Operators that have already been normalized (by id), keeping them alive so their ids are not reused
+NORMALIZED_OPERATORS = LRUCache(max_size=MAX_NORMALIZED_OPERATORS)
+
+def is_normalized(task):
+    # normalize only changes goals that are not conjunctions of literals
+    return all(NORMALIZED_OPERATORS.get(id(op)) is op for op in task.actions + task.axioms) and \
+           all(isinstance(literal, pddl.Literal) for literal in get_conjunctive_parts(task.goal))
+
+def normalize_task(task):
+    # Tasks built from the same domain share its (mutated in place) actions and axioms
+    if CACHE_PDDL and is_normalized(task):
+        return False
+    normalize.normalize(task)
+    for op in task.actions + task.axioms:
+        NORMALIZED_OPERATORS[id(op)] = op
+    return True
+
 ##################################################
 
 def get_derived_predicates(axioms):
@@ -320,37 +385,237 @@ def convert_cost(cost):
         return INFINITY
     return int(cost)
 
-def run_search(temp_dir, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF, debug=False):
+def get_search_args(planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF):
     max_time = convert_cost(max_planner_time)
     max_cost = INFINITY if max_cost == INF else scale_cost(max_cost)
-    start_time = time()
-    search = os.path.join(FD_BIN, SEARCH_COMMAND)
     if planner == 'cerberus':
         planner_config = SEARCH_OPTIONS[planner] # Check if max_time, max_cost exist
     else:
         planner_config = SEARCH_OPTIONS[planner] % (max_time, max_cost)
-    command = search.format(temp_dir + SEARCH_OUTPUT, planner_config, temp_dir + TRANSLATE_OUTPUT)
-    if debug:
-        print('Search command:', command)
+    # Arguments are passed directly to the binary (no shell) so the quotes in SEARCH_OPTIONS are stripped here
+    return tuple(shlex.split(planner_config))
+
+
+class SearchWorker(object):
+    """
+    A FastDownward search process that is started before its SAS task is available.
+    The process blocks on stdin until search() streams the task to it.
+    Each worker writes its plans to a private directory, so concurrent solvers never share plan files.
+    """
+    def __init__(self, search_args):
+        if not has_fd_build():
+            raise RuntimeError(BUILD_ERROR)
+        self.search_args = tuple(search_args)
+        self.plan_dir = tempfile.mkdtemp(prefix='pddlstream-')
+        self.plan_path = os.path.join(self.plan_dir, SEARCH_OUTPUT)
+        self.command = (os.path.join(FD_BIN, SEARCH_BINARY), '--internal-plan-file', self.plan_path) + self.search_args
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     cwd=None, close_fds=True, universal_newlines=True)
+    def is_alive(self):
+        return self.proc.poll() is None
+    def search(self, sas_input):
+        output, error = self.proc.communicate(input=sas_input)
+        return output
+    def start_search(self, sas_input):
+        # Non-blocking version of search() (the thread also drains stdout so the planner never blocks on it)
+        self.output = []
+        def communicate():
+            self.output.append(self.search(sas_input))
+        self.thread = threading.Thread(target=communicate)
+        self.thread.daemon = True
+        self.thread.start()
+    def iterate_solutions(self, poll_period=PLAN_POLL_PERIOD):
+        # Yields each improving (plan, cost) as soon as its plan file is completely written
+        parsed_files = set()
+        best_cost = INF
+        while True:
+            running = self.thread.is_alive() # Checked first so that the final plans are never missed
+            for plan_file in self.get_plan_files():
+                if plan_file in parsed_files:
+                    continue
+                solution = read(os.path.join(self.plan_dir, plan_file))
+                if running and not is_solution_written(solution):
+                    continue
+                plan, cost = parse_solution(solution)
+                parsed_files.add(plan_file)
+                if cost < best_cost:
+                    best_cost = cost
+                    yield plan, cost
+            if not running:
+                break
+            sleep(poll_period)
+    def get_plan_files(self):
+        return sorted(f for f in os.listdir(self.plan_dir) if f.startswith(SEARCH_OUTPUT))
+    def read_solutions(self):
+        return parse_solutions(self.plan_dir, self.get_plan_files())
+    def clean(self):
+        safe_rm_dir(self.plan_dir)
+    def stop(self):
+        if self.is_alive():
+            self.proc.kill()
+            self.proc.wait()
+    def kill(self):
+        self.stop()
+        self.clean()
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.proc.pid)
+
+
+class SearchPool(object):
+    """
+    Pre-started search workers, with at most one idle worker per planner.
+    Consuming a worker immediately starts its replacement, hiding process startup behind the caller's
+    subsequent work (e.g. stream evaluation and translation).
+    A replacement is only started once a planner's arguments repeat (max_cost often changes between searches),
+    and an idle worker whose arguments differ from the next search is killed.
+    The pool is shared by all threads; a worker is only ever handed to one caller.
+    """
+    def __init__(self, prestart=True):
+        self.prestart = prestart
+        self.idle_from_key = {}
+        self.args_from_key = {} # Arguments of the previous search
+        self.active = set() # Workers searching in the background (see stream_search)
+        self.lock = threading.Lock()
+    def start(self, key, search_args):
+        worker = SearchWorker(search_args)
+        with self.lock:
+            stale = self.idle_from_key.get(key, None)
+            self.idle_from_key[key] = worker
+        if stale is not None:
+            stale.kill()
+    def get_worker(self, search_args, key=None):
+        search_args = tuple(search_args)
+        if key is None:
+            key = search_args
+        with self.lock:
+            worker = self.idle_from_key.pop(key, None)
+            predictable = self.args_from_key.get(key, None) == search_args
+            self.args_from_key[key] = search_args
+        if (worker is not None) and ((worker.search_args != search_args) or not worker.is_alive()):
+            worker.kill() # Stale
+            worker = None
+        if worker is None:
+            worker = SearchWorker(search_args)
+        if self.prestart and predictable:
+            self.start(key, search_args)
+        return worker
+    def shutdown(self):
+        with self.lock:
+            workers = list(self.idle_from_key.values()) + list(self.active)
+            self.idle_from_key.clear()
+            self.active.clear()
+        for worker in workers:
+            worker.kill()
+    def __len__(self):
+        return len(self.idle_from_key)
+
+SEARCH_POOL = SearchPool(prestart=PRESTART_SEARCH)
+atexit.register(SEARCH_POOL.shutdown)
+
+def is_portfolio(planner):
+    return isinstance(planner, (list, tuple))
+
+def run_portfolio(sas_input, planners, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF,
+                  portfolio_time=PORTFOLIO_TIME, debug=False):
+    # Each configuration is a separate process, so they search on separate cores
+    start_time = time()
+    workers = [SEARCH_POOL.get_worker(get_search_args(planner, max_planner_time, max_cost), key=planner)
+               for planner in planners]
+    finished = Queue()
+    def search(worker):
+        try:
+            worker.search(sas_input)
+        finally:
+            finished.put(worker)
+    threads = []
+    for worker in workers:
+        if debug:
+            print('Search command:', ' '.join(worker.command))
+        thread = threading.Thread(target=search, args=(worker,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    def update_best(worker):
+        plan, cost = worker.read_solutions()
+        planner = planners[workers.index(worker)]
+        if debug:
+            print('Planner: {} | Cost: {} | Time: {:.3f}'.format(planner, cost, time() - start_time))
+        return (planner, plan, cost) if cost < best_cost else (best_planner, best_plan, best_cost)
+
+    best_planner, best_plan, best_cost = None, None, INF
+    unfinished = list(workers)
+    while unfinished and ((best_plan is None) or (portfolio_time is not None)):
+        timeout = None if portfolio_time is None else max(0, portfolio_time - (time() - start_time))
+        try:
+            worker = finished.get(timeout=timeout)
+        except Empty:
+            break
+        unfinished.remove(worker)
+        best_planner, best_plan, best_cost = update_best(worker)
+    for worker in unfinished: # Kills the configurations that are still searching
+        worker.stop()
+        if portfolio_time is not None: # Anytime configurations may have already written plans
+            best_planner, best_plan, best_cost = update_best(worker)
+    for worker in workers:
+        worker.kill()
+    for thread in threads:
+        thread.join()
+    print('Portfolio: {} | Planner: {} | Cost: {} | Runtime: {:.3f}'.format(
+        list(planners), best_planner, best_cost, time() - start_time))
+    return best_plan, best_cost
 
-    # os.popen is deprecated
-    # run, call, check_call, check_output
-    #with subprocess.Popen(command.split(), stdout=subprocess.PIPE, shell=True, cwd=None) as proc:
-    #    output = proc.stdout.read()
-    # CalledProcessError
-    #try:
-    #    output = subprocess.check_output(command, shell=True, cwd=None) #, timeout=None)
-    #except subprocess.CalledProcessError as e:
-    #    print(e)
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, cwd=None, close_fds=True)
-    output, error = proc.communicate()
+def stream_search(sas_input, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF,
+                  debug=False):
+    # Generates each improving (plan, cost) while the search is still running
+    # Closing the generator early kills the search
+    start_time = time()
+    worker = SEARCH_POOL.get_worker(get_search_args(planner, max_planner_time, max_cost), key=planner)
+    if debug:
+        print('Search command:', ' '.join(worker.command))
+    with SEARCH_POOL.lock:
+        SEARCH_POOL.active.add(worker)
+    try:
+        worker.start_search(sas_input)
+        for plan, cost in worker.iterate_solutions():
+            if debug:
+                print('Plan cost: {} | Search time: {:.3f}'.format(cost, time() - start_time))
+            yield plan, cost
+    finally:
+        with SEARCH_POOL.lock:
+            SEARCH_POOL.active.discard(worker)
+        worker.kill()
+
+
+def run_first_search(sas_input, debug=False, **search_args):
+    # Returns the first plan as soon as it is written and kills the search
+    # (instead of waiting for an anytime configuration to use up max_planner_time)
+    solutions = stream_search(sas_input, debug=debug, **search_args)
+    try:
+        return next(solutions, (None, INF))
+    finally:
+        solutions.close()
+
+def run_search(sas_input, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF,
+               portfolio_time=PORTFOLIO_TIME, stream=STREAM_PLANS, debug=False):
+    if is_portfolio(planner):
+        return run_portfolio(sas_input, planner, max_planner_time=max_planner_time, max_cost=max_cost,
+                             portfolio_time=portfolio_time, debug=debug)
+    if stream:
+        return run_first_search(sas_input, planner=planner, max_planner_time=max_planner_time,
+                                max_cost=max_cost, debug=debug)
+    start_time = time()
+    worker = SEARCH_POOL.get_worker(get_search_args(planner, max_planner_time, max_cost), key=planner)
+    if debug:
+        print('Search command:', ' '.join(worker.command))
+    output = worker.search(sas_input)
     if debug:
         print(output[:-1])
         print('Search runtime:', time() - start_time)
-    temp_path = os.path.join(os.getcwd(), TEMP_DIR)
-    plan_files = sorted(f for f in os.listdir(temp_path) if f.startswith(SEARCH_OUTPUT))
-    print('Plans:', plan_files)
-    return parse_solutions(temp_path, plan_files)
+    print('Plans:', worker.get_plan_files())
+    solution = worker.read_solutions()
+    worker.clean()
+    return solution
 
 ##################################################
 
@@ -360,6 +625,10 @@ def parse_action(line):
     args = tuple(entries[1:])
     return Action(name, args)
 
+def is_solution_written(solution):
+    # The cost is the last line written, so the plan is complete once the cost line ends
+    return re.search(r'cost\s*=\s*\d+[^\n]*\n', solution) is not None
+
 def parse_solution(solution):
     #action_regex = r'\((\w+(\s+\w+)\)' # TODO: regex
     cost = INF
@@ -383,7 +652,12 @@ def parse_solutions(temp_path, plan_files):
             best_plan, best_cost = plan, cost
     return best_plan, best_cost
 
-def write_pddl(domain_pddl=None, problem_pddl=None, temp_dir=TEMP_DIR):
+def get_temp_dir(temp_dir=None):
+    # Defaults to the working directory of the active SolverContext
+    return get_context().temp_dir if temp_dir is None else temp_dir
+
+def write_pddl(domain_pddl=None, problem_pddl=None, temp_dir=None):
+    temp_dir = get_temp_dir(temp_dir)
     clear_dir(temp_dir)
     domain_path = os.path.join(temp_dir, DOMAIN_INPUT)
     if domain_pddl is not None:
@@ -397,9 +671,13 @@ def write_pddl(domain_pddl=None, problem_pddl=None, temp_dir=TEMP_DIR):
 
 def literal_holds(state, literal):
     #return (literal in state) != literal.negated
+    if isinstance(state, BitState):
+        return state.literal_holds(literal)
     return (literal.positive() in state) != literal.negated
 
 def conditions_hold(state, conditions):
+    if isinstance(state, BitState):
+        return state.conditions_hold(conditions)
     return all(literal_holds(state, cond) for cond in conditions)
 
 def get_precondition(operator):
@@ -422,10 +700,15 @@ def get_effects(operator):
     return [effect for _, effect in get_conditional_effects(operator)]
 
 def is_applicable(state, action):
+    if isinstance(state, BitState):
+        return state.is_applicable(action) # Compiled once per AtomIndex
     return conditions_hold(state, get_precondition(action))
 
 def apply_action(state, action):
     assert(isinstance(action, pddl.PropositionalAction))
+    if isinstance(state, BitState):
+        state.apply_action(action)
+        return
     # TODO: signed literals
     for conditions, effect in action.del_effects:
         if conditions_hold(state, conditions):
@@ -439,11 +722,12 @@ def apply_axiom(state, axiom):
     state.add(axiom.effect)
 
 def is_valid_plan(initial_state, plan): #, goal):
-    state = set(initial_state)
-    for action in plan:
-        if not is_applicable(state, action):
+    index = AtomIndex()
+    bits = index.encode(initial_state)
+    for action in map(index.compile, plan):
+        if not action.is_applicable(bits):
             return False
-        apply_action(state, action)
+        bits = action.apply(bits)
     return True
 
 #def apply_lifted_action(state, action):
@@ -3,8 +3,9 @@ from __future__ import print_function
 import time
 
 from pddlstream.algorithms.algorithm import parse_problem
-from pddlstream.algorithms.common import SolutionStore, stream_plan_complexity
+from pddlstream.algorithms.common import SolutionStore, EvaluationCursor, stream_plan_complexity
 from pddlstream.algorithms.constraints import PlanConstraints
+from pddlstream.algorithms.context import with_context
 from pddlstream.algorithms.disabled import push_disabled, reenable_disabled, process_stream_plan
 from pddlstream.algorithms.disable_skeleton import create_disabled_axioms
 from pddlstream.algorithms.incremental import process_stream_queue
@@ -15,6 +16,7 @@ from pddlstream.algorithms.skeleton import SkeletonQueue
 from pddlstream.algorithms.visualization import reset_visualizations, create_visualizations, \
     has_pygraphviz, log_plans
 from pddlstream.language.constants import is_plan, get_length, str_from_plan, INFEASIBLE
+from pddlstream.language.conversion import is_atom
 from pddlstream.language.function import Function, Predicate
 from pddlstream.language.optimizer import ComponentStream
 from pddlstream.algorithms.recover_optimizers import combine_optimizers, replan_with_optimizers
@@ -38,6 +40,7 @@ def partition_externals(externals, verbose=False):
             streams, functions, negative, optimizers))
     return streams, functions, negative, optimizers
 
+@with_context
 def solve_focused(problem, constraints=PlanConstraints(), stream_info={}, replan_actions=set(),
                   max_time=INF, max_iterations=INF,
                   initial_complexity=0, complexity_step=1,
@@ -65,6 +68,7 @@ def solve_focused(problem, constraints=PlanConstraints(), stream_info={}, replan
     :param search_sample_ratio: the desired ratio of search time / sample time
     :param visualize: if True, it draws the constraint network and stream plan as a graphviz file
     :param verbose: if True, this prints the result of each stream application
+    :param context: an optional SolverContext that isolates this solve's files, objects, and statistics
     :param search_kwargs: keyword args for the search subroutine
     :return: a tuple (plan, cost, evaluations) where plan is a sequence of actions
         (or None), cost is the cost of the plan, and evaluations is init but expanded
@@ -96,10 +100,17 @@ def solve_focused(problem, constraints=PlanConstraints(), stream_info={}, replan
     assert implies(has_optimizers, use_skeletons)
     skeleton_queue = SkeletonQueue(store, domain, disable=not has_optimizers)
     disabled = set() # Max skeletons after a solution
+    eager_instantiator = Instantiator(eager_externals)
+    evaluation_cursor = EvaluationCursor(evaluations)
     while (not store.is_terminated()) and (num_iterations < max_iterations):
         start_time = time.time()
         num_iterations += 1
-        eager_instantiator = Instantiator(eager_externals, evaluations) # Only update after an increase?
+        removed_evaluations, added_evaluations = evaluation_cursor.update() # Only the changes since the last iteration
+        for evaluation in removed_evaluations:
+            if is_atom(evaluation):
+                eager_instantiator.remove_atom(evaluation.head) # Blocked facts are removed when reenabled
+        for evaluation in added_evaluations:
+            eager_instantiator.add_atom(evaluation, evaluations[evaluation].complexity)
         if eager_disabled:
             push_disabled(eager_instantiator, disabled)
         eager_calls += process_stream_queue(eager_instantiator, store,
@@ -1,6 +1,7 @@
 from pddlstream.algorithms.algorithm import parse_problem
 from pddlstream.algorithms.common import add_facts, add_certified, SolutionStore
 from pddlstream.algorithms.constraints import PlanConstraints
+from pddlstream.algorithms.context import with_context, bind_context
 from pddlstream.algorithms.downward import get_problem, task_from_domain_problem
 from pddlstream.algorithms.instantiate_task import sas_from_pddl
 from pddlstream.algorithms.instantiation import Instantiator
@@ -9,16 +10,25 @@ from pddlstream.language.constants import is_plan
 from pddlstream.language.conversion import obj_from_pddl_plan
 from pddlstream.language.fluent import ensure_no_fluent_streams
 from pddlstream.language.statistics import load_stream_statistics, write_stream_statistics
+from pddlstream.language.stream import prepare_batch
 from pddlstream.language.temporal import solve_tfd, SimplifiedDomain
 from pddlstream.language.write_pddl import get_problem_pddl
 from pddlstream.utils import INF
 
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = wait = None
+
 UPDATE_STATISTICS = False
+STREAM_WORKERS = 1 # Number of stream calls made concurrently by process_stream_queue (1 is sequential)
+# Worker threads only speed up procedures that release the GIL (e.g. numpy, compiled collision checkers, I/O,
+# or other processes); pure-Python CPU-bound samplers still run one at a time
 
-def process_instance(instantiator, evaluations, instance, verbose=False): #, **complexity_args):
+def process_instance(instantiator, evaluations, instance, verbose=False, max_time=INF): #, **complexity_args):
     if instance.enumerated:
         return False
-    new_results, new_facts = instance.next_results(verbose=verbose)
+    new_results, new_facts = instance.next_results(verbose=verbose, max_time=max_time)
     #remove_blocked(evaluations, instance, new_results)
     for result in new_results:
         complexity = result.compute_complexity(evaluations)
@@ -45,10 +55,99 @@ def solve_finite(evaluations, goal_exp, domain, unit_costs=False, debug=False, *
 
 ##################################################
 
-def process_stream_queue(instantiator, store, complexity_limit, **kwargs):
+def pop_instances(instantiator, instance, complexity_limit):
+    # Ready instances of a stream with a batch procedure are called together (see from_batch_fn)
+    if instance.enumerated or not instance.external.is_batched():
+        return [instance]
+    return instantiator.pop_batch(instance, complexity_limit, instance.external.info.batch_size)
+
+def prepare_instances(instances, max_time=INF):
+    if len(instances) == 1:
+        instances[0].prepare(max_time)
+    else:
+        prepare_batch(instances)
+
+def discard_prepared(instances):
+    # The outputs prepared for instances that were not processed (e.g. after an exception) are dropped
+    for instance in instances:
+        instance.discard_prepared()
+
+def requeue_instances(instantiator, instances):
+    # Popped instances that were not processed (e.g. after an exception) are pushed back
+    for instance in instances:
+        if not instance.enumerated and instantiator.is_live(instance):
+            instantiator.push_instance(instance)
+
+def pop_stream_batch(instantiator, complexity_limit, max_size):
+    # Pops up to max_size distinct calls that are ready at the complexity limit
+    batch = []
+    selected = set()
+    while instantiator and (len(batch) < max_size) and (instantiator.min_complexity() <= complexity_limit):
+        instance = instantiator.pop_stream()
+        if instance.enumerated or not instantiator.is_live(instance):
+            continue
+        if (instance in selected) or (complexity_limit < instantiator.compute_complexity(instance)):
+            instantiator.push_instance(instance) # Duplicate or stale priority
+            if instance in selected:
+                break
+            continue
+        instances = [other for other in pop_instances(instantiator, instance, complexity_limit)
+                     if other not in selected]
+        batch.append(instances)
+        selected.update(instances)
+    return batch
+
+def process_stream_batches(instantiator, store, complexity_limit, num_workers, **kwargs):
+    # The user procedures are called concurrently by worker threads
+    # Objects, statistics, evaluations, and the instantiator are then updated on this thread in pop order,
+    # so the merged result only depends on the batch (and not on which calls finish first)
+    num_calls = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while not store.is_terminated():
+            batch = pop_stream_batch(instantiator, complexity_limit, num_workers)
+            if not batch:
+                break
+            prepare_fn = bind_context(prepare_instances)
+            futures = [executor.submit(prepare_fn, instances, store.time_remaining()) for instances in batch]
+            popped = [instance for instances in batch for instance in instances]
+            num_processed = 0
+            try:
+                for instances, future in zip(batch, futures):
+                    future.result() # Reraises exceptions from the procedure
+                    for instance in instances:
+                        num_calls += process_instance(instantiator, store.evaluations, instance, **kwargs)
+                        num_processed += 1
+            finally:
+                wait(futures) # Otherwise a call could still prepare its instance after an exception
+                discard_prepared(popped[num_processed:])
+                requeue_instances(instantiator, popped[num_processed:])
+    return num_calls
+
+def process_stream_queue(instantiator, store, complexity_limit, num_workers=None, **kwargs):
+    if num_workers is None:
+        num_workers = STREAM_WORKERS
+    if (1 < num_workers) and (ThreadPoolExecutor is not None):
+        return process_stream_batches(instantiator, store, complexity_limit, num_workers, **kwargs)
     num_calls = 0
     while not store.is_terminated() and instantiator and (instantiator.min_complexity() <= complexity_limit):
-        num_calls += process_instance(instantiator, store.evaluations, instantiator.pop_stream(), **kwargs)
+        instance = instantiator.pop_stream()
+        if not instantiator.is_live(instance):
+            continue # A domain atom was removed (regenerated if it is added again)
+        if complexity_limit < instantiator.compute_complexity(instance):
+            instantiator.push_instance(instance) # Stale priority (called since it was pushed)
+            continue
+        instances = pop_instances(instantiator, instance, complexity_limit)
+        num_processed = 0
+        try:
+            if len(instances) != 1:
+                prepare_batch(instances)
+            for instance in instances:
+                num_calls += process_instance(instantiator, store.evaluations, instance,
+                                              max_time=store.time_remaining(), **kwargs)
+                num_processed += 1
+        finally:
+            discard_prepared(instances[num_processed:])
+            requeue_instances(instantiator, instances[num_processed:])
     return num_calls
 
 # def retrace_stream_plan(store, domain, goal_expression):
@@ -61,6 +160,7 @@ def process_stream_queue(instantiator, store, complexity_limit, **kwargs):
 #     plan_preimage(store.best_plan, goal_expression)
 #     raise NotImplementedError()
 
+@with_context
 def solve_incremental(problem, constraints=PlanConstraints(),
                       unit_costs=False, success_cost=INF,
                       max_iterations=INF, max_time=INF,
@@ -78,6 +178,7 @@ def solve_incremental(problem, constraints=PlanConstraints(),
     :param complexity_step: the increase in the complexity limit after each iteration
     :param max_complexity: the maximum stream complexity
     :param verbose: if True, this prints the result of each stream application
+    :param context: an optional SolverContext that isolates this solve's files, objects, and statistics
     :param search_args: keyword args for the search subroutine
     :return: a tuple (plan, cost, evaluations) where plan is a sequence of actions
         (or None), cost is the cost of the plan, and evaluations is init but expanded
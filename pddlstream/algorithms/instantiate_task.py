@@ -4,12 +4,18 @@ import os
 from collections import namedtuple, defaultdict, deque
 from time import time
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from pddlstream.algorithms.context import get_context
 from pddlstream.algorithms.downward import get_literals, get_precondition, get_fluents, get_function_assignments, \
     TRANSLATE_OUTPUT, parse_sequential_domain, parse_problem, task_from_domain_problem, GOAL_NAME, literal_holds, \
-    get_effects, get_conjunctive_parts, get_conditional_effects
+    get_effects, get_conjunctive_parts, get_conditional_effects, normalize_task
 from pddlstream.algorithms.relation import Relation, compute_order, solve_satisfaction
 from pddlstream.language.constants import is_parameter
-from pddlstream.utils import flatten, apply_mapping, MockSet, elapsed_time, clear_dir, Verbose
+from pddlstream.utils import flatten, apply_mapping, MockSet, elapsed_time, clear_dir, Verbose, LRUCache
 
 import pddl
 import instantiate
@@ -17,6 +23,8 @@ import translate
 import normalize
 
 FD_INSTANTIATE = True
+INCREMENTAL_GROUNDING = True # Reuses the relaxed reachability model across calls whose init only grows
+MAX_MODELS = 2 # Models kept per solve, one per domain (e.g. plan_streams grounds the stream and temporary domains)
 
 InstantiatedTask = namedtuple('InstantiatedTask', ['task', 'atoms', 'actions', 'axioms',
                                                    'reachable_action_params', 'goal_list'])
@@ -74,7 +82,8 @@ def get_achieving_axioms(state, operators, negated_from_name={}):
     # marking algorithm for propositional Horn logic
     unprocessed_from_literal = defaultdict(list)
     operator_from_literal = {}
-    remaining_from_stream = {}
+    achievers = [] # (op, effect) indexed by integer ids
+    remaining = [] # Number of unsatisfied conditions per achiever
     reachable_operators = set() # TODO: only keep facts
 
     queue = deque()
@@ -88,23 +97,24 @@ def get_achieving_axioms(state, operators, negated_from_name={}):
     for op in operators:
         preconditions = get_precondition(op)
         for cond, effect in get_conditional_effects(op):
-            conditions = cond + preconditions
-            remaining_from_stream[id(op), effect] = 0
-            for literal in filter_negated(conditions, negated_from_name):
+            achiever = len(achievers)
+            achievers.append((op, effect))
+            remaining.append(0)
+            for literal in filter_negated(cond + preconditions, negated_from_name):
                 if literal_holds(state, literal):
                     operator_from_literal[literal] = None
                 else:
-                    remaining_from_stream[id(op), effect] += 1
-                    unprocessed_from_literal[literal].append((op, effect))
-            if remaining_from_stream[id(op), effect] == 0:
+                    remaining[achiever] += 1
+                    unprocessed_from_literal[literal].append(achiever)
+            if remaining[achiever] == 0:
                 process_axiom(op, effect)
 
     while queue:
         literal = queue.popleft()
-        for op, effect in unprocessed_from_literal[literal]:
-            remaining_from_stream[id(op), effect] -= 1
-            if remaining_from_stream[id(op), effect] == 0:
-                process_axiom(op, effect)
+        for achiever in unprocessed_from_literal[literal]:
+            remaining[achiever] -= 1
+            if remaining[achiever] == 0:
+                process_axiom(*achievers[achiever])
     return operator_from_literal, [op for op in operators if id(op) in reachable_operators]
 
 ##################################################
@@ -159,11 +169,95 @@ def instantiate_domain(task, prune_static=True):
 
 ##################################################
 
-def instantiate_task(task, check_infeasible=True, **kwargs):
+OBJECT_PREDICATE = '@object' # Added by pddl_to_prolog for rules with unbound effect variables
+
+def get_model_key(task):
+    # The Datalog rules only depend on the (normalized) actions, axioms, and goal
+    return tuple(map(id, task.actions)), tuple(map(id, task.axioms)), task.goal
+
+def get_model_facts(task):
+    import pddl_to_prolog
+    prog = pddl_to_prolog.PrologProgram()
+    pddl_to_prolog.translate_facts(prog, task) # Init atoms and object type atoms
+    return {fact.atom for fact in prog.facts}
+
+
+class IncrementalModel(object):
+    """
+    FastDownward's relaxed reachability (Datalog) model that persists across calls.
+    The rules keep their join indices, so adding facts only processes the consequences of the new facts.
+    This is sound because the exploration rules are monotone (negative conditions are relaxed away).
+    """
+    def __init__(self, task):
+        import pddl_to_prolog
+        import build_model
+        self.key = get_model_key(task)
+        self.operators = tuple(task.actions) + tuple(task.axioms) # Ensures the ids in key are not reused
+        prog = pddl_to_prolog.translate(task)
+        self.unifier = build_model.Unifier(build_model.convert_rules(prog))
+        # Same initial queue as build_model.compute_model
+        fact_atoms = sorted(fact.atom for fact in prog.facts)
+        self.queue = build_model.Queue(fact_atoms)
+        self.facts = set(fact_atoms)
+        # Facts that translate adds while normalizing (trivial rules and @object atoms) rather than from the task
+        self.program_facts = self.facts - get_model_facts(task)
+        # Rules with unbound effect variables are conditioned on @object, which must hold for new objects as well
+        self.uses_objects = any(condition.predicate == OBJECT_PREDICATE
+                                for rule in prog.rules for condition in rule.conditions)
+        self.objects = {arg for atom in fact_atoms for arg in atom.args}
+        self.num_updates = 0
+    def is_compatible(self, task, facts):
+        return (get_model_key(task) == self.key) and (self.facts <= (facts | self.program_facts))
+    def update(self, facts):
+        new_facts = facts - self.facts
+        for atom in new_facts:
+            self.queue.push(atom.predicate, atom.args)
+            if self.uses_objects:
+                for obj in atom.args:
+                    if obj not in self.objects:
+                        self.objects.add(obj)
+                        self.queue.push(OBJECT_PREDICATE, (obj,))
+        self.facts.update(new_facts)
+        self.num_updates += 1
+        while self.queue:
+            atom = self.queue.pop()
+            for rule, cond_index in self.unifier.unify(atom):
+                rule.update_index(atom, cond_index)
+                rule.fire(atom, cond_index, self.queue.push)
+        return new_facts
+    @property
+    def atoms(self):
+        return self.queue.queue
+    def __repr__(self):
+        return '{}(facts={}, atoms={}, updates={})'.format(
+            self.__class__.__name__, len(self.facts), len(self.atoms), self.num_updates)
+
+
+def explore_incremental(task, debug=False):
+    # Drop-in replacement for instantiate.explore(task)
+    caches = get_context().caches
+    if IncrementalModel not in caches:
+        caches[IncrementalModel] = LRUCache(max_size=MAX_MODELS)
+    models = caches[IncrementalModel] # Keyed by domain so that grounding different domains does not evict models
+    key = get_model_key(task)
+    facts = get_model_facts(task)
+    model = models.get(key)
+    if (model is None) or not model.is_compatible(task, facts):
+        model = models[key] = IncrementalModel(task)
+    new_facts = model.update(facts)
+    if debug:
+        print('Model: {} | New facts: {}'.format(model, len(new_facts)))
+    return instantiate.instantiate(task, model.atoms)
+
+##################################################
+
+def instantiate_task(task, check_infeasible=True, debug=False, **kwargs):
     start_time = time()
     print()
-    normalize.normalize(task)
-    if FD_INSTANTIATE:
+    normalize_task(task)
+    if FD_INSTANTIATE and INCREMENTAL_GROUNDING:
+        relaxed_reachable, atoms, actions, axioms, reachable_action_params = explore_incremental(task, debug=debug)
+    elif FD_INSTANTIATE:
         relaxed_reachable, atoms, actions, axioms, reachable_action_params = instantiate.explore(task)
     else:
         relaxed_reachable, atoms, actions, axioms = instantiate_domain(task, **kwargs)
@@ -242,7 +336,38 @@ def sas_from_instantiated(instantiated_task):
 
 ##################################################
 
+def output_sas_component(component):
+    buffer = StringIO()
+    component.output(buffer)
+    return buffer.getvalue()
+
+def serialize_sas_task(sas_task, serialized=None):
+    # In-memory version of write_sas_task that is piped directly to the planner
+    # serialized caches the text of components shared (by identity) across copies of the same task
+    # The init and goal are always written because they are modified in place
+    if serialized is None:
+        return output_sas_component(sas_task)
+    import sas_tasks
+    def output(component):
+        key = id(component)
+        if key not in serialized:
+            serialized[key] = (component, output_sas_component(component)) # Keeps the id alive
+        return serialized[key][1]
+    header = ['begin_version', str(sas_tasks.SAS_FILE_VERSION), 'end_version',
+              'begin_metric', str(int(sas_task.metric)), 'end_metric']
+    parts = ['\n'.join(header) + '\n', output(sas_task.variables)]
+    parts.append('{}\n'.format(len(sas_task.mutexes)))
+    parts.extend(map(output, sas_task.mutexes))
+    parts.extend([output_sas_component(sas_task.init), output_sas_component(sas_task.goal)])
+    parts.append('{}\n'.format(len(sas_task.operators)))
+    parts.extend(map(output, sas_task.operators))
+    parts.append('{}\n'.format(len(sas_task.axioms)))
+    parts.extend(map(output, sas_task.axioms))
+    return ''.join(parts)
+
+
 def write_sas_task(sas_task, temp_dir):
+    # Only used for debugging purposes
     clear_dir(temp_dir)
     translate_path = os.path.join(temp_dir, TRANSLATE_OUTPUT)
     with open(os.path.join(temp_dir, TRANSLATE_OUTPUT), "w") as output_file:
@@ -254,16 +379,20 @@ def sas_from_pddl(task, debug=False):
     #normalize.normalize(task)
     #sas_task = translate.pddl_to_sas(task)
     with Verbose(debug):
-        instantiated = instantiate_task(task)
+        instantiated = instantiate_task(task, debug=debug)
         sas_task = sas_from_instantiated(instantiated)
         sas_task.metric = task.use_min_cost_metric # TODO: are these sometimes not equal?
     return sas_task
 
 
-def translate_and_write_pddl(domain_pddl, problem_pddl, temp_dir, verbose):
+def translate_pddl(domain_pddl, problem_pddl):
     domain = parse_sequential_domain(domain_pddl)
     problem = parse_problem(domain, problem_pddl)
     task = task_from_domain_problem(domain, problem)
-    sas_task = sas_from_pddl(task)
+    return sas_from_pddl(task)
+
+
+def translate_and_write_pddl(domain_pddl, problem_pddl, temp_dir, verbose):
+    sas_task = translate_pddl(domain_pddl, problem_pddl)
     write_sas_task(sas_task, temp_dir)
-    return task
+    return sas_task
@@ -1,6 +1,7 @@
-from collections import defaultdict, namedtuple, Sized
+from collections import defaultdict, namedtuple, Sized, Counter, OrderedDict
 from heapq import heappush, heappop
 from itertools import product
+from types import GeneratorType
 
 from pddlstream.algorithms.common import COMPLEXITY_OP
 from pddlstream.algorithms.relation import compute_order, Relation, solve_satisfaction
@@ -8,6 +9,9 @@ from pddlstream.language.constants import is_parameter
 from pddlstream.language.conversion import is_atom, head_from_fact
 from pddlstream.utils import safe_zip, HeapElement
 
+JOIN_DOMAINS = True # Semi-naive hash join (otherwise the cartesian product is filtered by test_mapping)
+LAZY_INSTANCES = True # The queue holds generators of instances until their lower bound complexity is reached
+
 # TODO: maybe store unit complexity here as well as a tiebreaker
 Priority = namedtuple('Priority', ['complexity', 'num']) # num ensures FIFO
 
@@ -16,6 +20,24 @@ def is_instance(atom, schema):
             all(is_parameter(b) or (a == b)
                 for a, b in safe_zip(atom.args, schema.args))
 
+def get_domain_index(streams):
+    # (function, arity) -> [(stream index, domain index, constant (position, arg) pairs)]
+    domain_index = defaultdict(list)
+    for s_idx, stream in enumerate(streams):
+        for d_idx, domain_fact in enumerate(stream.domain):
+            domain_atom = head_from_fact(domain_fact)
+            constants = tuple((i, arg) for i, arg in enumerate(domain_atom.args) if not is_parameter(arg))
+            domain_index[domain_atom.function, len(domain_atom.args)].append((s_idx, d_idx, constants))
+    return domain_index
+
+def extend_mapping(mapping, schema, atom):
+    # Binds the parameters of schema to the args of atom (constants are already checked by the domain index)
+    new_mapping = dict(mapping)
+    for param, arg in safe_zip(schema.args, atom.args):
+        if is_parameter(param) and (new_mapping.setdefault(param, arg) != arg):
+            return None
+    return new_mapping
+
 def test_mapping(atoms1, atoms2):
     mapping = {}
     for a1, a2 in safe_zip(atoms1, atoms2):
@@ -36,11 +58,19 @@ class Instantiator(Sized): # Dynamic Instantiator
         # TODO: lazily instantiate upon demand
         self.streams = streams
         #self.streams_from_atom = defaultdict(list)
-        self.queue = []
+        self.queue = [] # (priority, stream) of the front of each stream's queue
+        self.queue_from_stream = {} # stream -> heap of (priority, instance or cursor)
+        self.num_elements = 0
         self.num_pushes = 0 # shared between the queues
+        self.num_queued = Counter() # Number of copies of each instance in the queue
         # TODO: rename atom to head in most places
         self.complexity_from_atom = {}
+        self.stamp_from_atom = {} # Domain atoms stamped before an atom was (re)added are stale (see remove_atom)
         self.atoms_from_domain = defaultdict(list)
+        self.num_domain_atoms = 0 # Orders the atoms of every domain fact (see _join)
+        self.domain_index = get_domain_index(self.streams) # Only streams that can consume an atom are visited
+        self.tables_from_domain = defaultdict(dict) # (s_idx, d_idx) -> {key parameters: {key: [(stamp, atom)]}}
+        self.stamps_from_domain = defaultdict(list)
         for stream in self.streams:
             if not stream.domain:
                 assert not stream.inputs
@@ -52,40 +82,138 @@ class Instantiator(Sized): # Dynamic Instantiator
     #########################
 
     def __len__(self):
-        return len(self.queue)
+        self._expand_cursors() # Nonzero only if there is an instance at the front
+        return self.num_elements
 
     def compute_complexity(self, instance):
         domain_complexity = COMPLEXITY_OP([self.complexity_from_atom[head_from_fact(f)]
                                            for f in instance.get_domain()] + [0])
         return domain_complexity + instance.external.get_complexity(instance.num_calls)
 
-    def push_instance(self, instance):
+    def _push(self, external, priority, value):
+        queue = self.queue_from_stream.setdefault(external, [])
+        if not queue or (priority < queue[0].key):
+            heappush(self.queue, HeapElement(priority, external))
+        heappush(queue, HeapElement(priority, value))
+        self.num_elements += 1
+
+    def _pop(self, external):
+        queue = self.queue_from_stream[external]
+        element = heappop(queue)
+        self.num_elements -= 1
+        if queue:
+            heappush(self.queue, HeapElement(queue[0].key, external))
+        else:
+            del self.queue_from_stream[external]
+        return element
+
+    def _dequeue(self, instance):
+        self.num_queued[instance] -= 1
+        if not self.num_queued[instance]:
+            del self.num_queued[instance]
+
+    def push_instance(self, instance, num=None):
         # TODO: flush stale priorities?
         complexity = self.compute_complexity(instance)
-        priority = Priority(complexity, self.num_pushes)
-        heappush(self.queue, HeapElement(priority, instance))
+        if num is None:
+            num = self.num_pushes
+            self.num_pushes += 1
+        self._push(instance.external, Priority(complexity, num), instance)
+        self.num_queued[instance] += 1
+
+    def is_queued(self, instance):
+        return 0 < self.num_queued[instance]
+
+    def push_cursor(self, stream, instances, complexity):
+        # instances is a generator of instances of stream that all have at least this complexity
+        if not LAZY_INSTANCES:
+            for instance in instances:
+                if self.is_live(instance):
+                    self.push_instance(instance)
+            return
+        self._push(stream, Priority(complexity, self.num_pushes), instances)
         self.num_pushes += 1
 
+    def _expand_cursor(self, stream, priority, instances):
+        instance = next(instances, None)
+        if instance is not None:
+            if self.is_live(instance):
+                self.push_instance(instance, num=priority.num) # Takes the place of the cursor
+            # A fresh num orders the cursor after the instance it emitted
+            self.push_cursor(stream, instances, priority.complexity)
+
+    def _expand_cursors(self):
+        # Materializes instances until one is at the front of the queue
+        # self.queue holds the front priority of each stream's queue; elements that are no longer the front are stale
+        while self.queue:
+            priority, external = self.queue[0]
+            queue = self.queue_from_stream.get(external)
+            if not queue or (queue[0].key != priority):
+                heappop(self.queue)
+            elif isinstance(queue[0].value, GeneratorType):
+                self._expand_cursor(external, *self._pop(external))
+            else:
+                break
+
+    def peek_stream(self):
+        self._expand_cursors()
+        _, external = self.queue[0]
+        priority, instance = self.queue_from_stream[external][0]
+        return instance
+
     def pop_stream(self):
-        priority, instance = heappop(self.queue)
+        self._expand_cursors()
+        _, external = self.queue[0]
+        priority, instance = self._pop(external)
+        self._dequeue(instance)
         return instance
 
+    def pop_batch(self, instance, complexity_limit, max_size):
+        # Removes queued instances of the same stream as instance that are ready at complexity_limit
+        # The stream's cursors are expanded as needed to fill the batch
+        batch = [instance]
+        selected = {instance}
+        stale = []
+        external = instance.external
+        while (len(batch) < max_size) and (external in self.queue_from_stream):
+            priority, other = self.queue_from_stream[external][0]
+            if complexity_limit < priority.complexity:
+                break
+            self._pop(external)
+            if isinstance(other, GeneratorType):
+                self._expand_cursor(external, priority, other)
+                continue
+            self._dequeue(other)
+            if (other in selected) or other.enumerated or not self.is_live(other):
+                continue # Duplicate, or regenerated if a removed atom is added again
+            if complexity_limit < self.compute_complexity(other):
+                stale.append(other) # Stale priority (called since it was pushed)
+                continue
+            batch.append(other)
+            selected.add(other)
+        for other in stale:
+            self.push_instance(other)
+        return batch
+
     def min_complexity(self):
+        self._expand_cursors()
         priority, _ = self.queue[0]
         return priority.complexity
 
     #########################
 
-    def _add_combinations(self, stream, atoms):
-        if not all(atoms):
-            return
+    def _get_live_atoms(self, atoms):
+        # Removed atoms are skipped and re-added atoms are listed once
+        return [atom for atom in OrderedDict.fromkeys(atoms) if atom in self.complexity_from_atom]
+
+    def _get_combinations(self, stream, atoms):
         domain = list(map(head_from_fact, stream.domain))
         # Most constrained variable/atom to least constrained
         for combo in product(*atoms):
             mapping = test_mapping(domain, combo)
             if mapping is not None:
                 input_objects = tuple(mapping[p] for p in stream.inputs)
-                self.push_instance(stream.get_instance(input_objects))
+                yield stream.get_instance(input_objects)
 
     def _add_combinations_relation(self, stream, atoms):
         if not all(atoms):
@@ -103,17 +231,76 @@ class Instantiator(Sized): # Dynamic Instantiator
             input_objects = tuple(mapping[p] for p in stream.inputs)
             self.push_instance(stream.get_instance(input_objects))
 
+    def _get_table(self, s_idx, d_idx, parameters):
+        # Hash index of the atoms matching a domain fact on the values of parameters
+        tables = self.tables_from_domain[s_idx, d_idx]
+        if parameters not in tables:
+            domain_atom = head_from_fact(self.streams[s_idx].domain[d_idx])
+            positions = tuple(domain_atom.args.index(param) for param in parameters)
+            table = defaultdict(list)
+            for stamp, atom in safe_zip(self.stamps_from_domain[s_idx, d_idx], self.atoms_from_domain[s_idx, d_idx]):
+                table[tuple(atom.args[i] for i in positions)].append((stamp, atom))
+            tables[parameters] = (positions, table)
+        return tables[parameters][1]
+
+    def _add_domain_atom(self, s_idx, d_idx, new_atom):
+        stamp = self.num_domain_atoms
+        self.num_domain_atoms += 1
+        self.atoms_from_domain[s_idx, d_idx].append(new_atom)
+        self.stamps_from_domain[s_idx, d_idx].append(stamp)
+        for positions, table in self.tables_from_domain[s_idx, d_idx].values():
+            table[tuple(new_atom.args[i] for i in positions)].append((stamp, new_atom))
+        return stamp
+
+    def _join(self, s_idx, domain, order, mapping, stamp):
+        # Depth-first so that a lazy cursor only computes the bindings it yields
+        if not order:
+            yield mapping
+            return
+        index = order[0]
+        parameters = tuple(sorted({arg for arg in domain[index].args if arg in mapping}))
+        table = self._get_table(s_idx, index, parameters)
+        for atom_stamp, atom in table.get(tuple(mapping[param] for param in parameters), []):
+            if stamp <= atom_stamp:
+                break # Atoms added later are joined by their own cursors (tables are ordered by stamp)
+            if (atom not in self.complexity_from_atom) or (atom_stamp < self.stamp_from_atom[atom]):
+                continue # Removed (and possibly re-added)
+            new_mapping = extend_mapping(mapping, domain[index], atom)
+            if new_mapping is not None:
+                for full_mapping in self._join(s_idx, domain, order[1:], new_mapping, stamp):
+                    yield full_mapping
+
+    def _get_combinations_join(self, s_idx, d_idx, new_atom, stamp):
+        # Semi-naive evaluation: only bindings that use new_atom for domain fact d_idx are enumerated
+        stream = self.streams[s_idx]
+        domain = list(map(head_from_fact, stream.domain))
+        mapping = extend_mapping({}, domain[d_idx], new_atom)
+        if mapping is None:
+            return
+        atoms = [self.atoms_from_domain[s_idx, d2_idx] if d_idx != d2_idx else [new_atom]
+                 for d2_idx in range(len(domain))]
+        order = [index for index in compute_order(domain, atoms) if index != d_idx]
+        for mapping in self._join(s_idx, domain, order, mapping, stamp):
+            input_objects = tuple(mapping[p] for p in stream.inputs)
+            yield stream.get_instance(input_objects)
+
     def _add_new_instances(self, new_atom):
-        for s_idx, stream in enumerate(self.streams):
-            for d_idx, domain_fact in enumerate(stream.domain):
-                domain_atom = head_from_fact(domain_fact)
-                if is_instance(new_atom, domain_atom):
-                    # TODO: handle domain constants more intelligently
-                    self.atoms_from_domain[s_idx, d_idx].append(new_atom)
-                    atoms = [self.atoms_from_domain[s_idx, d2_idx] if d_idx != d2_idx else [new_atom]
-                              for d2_idx in range(len(stream.domain))]
-                    self._add_combinations(stream, atoms)
+        for s_idx, d_idx, constants in self.domain_index.get((new_atom.function, len(new_atom.args)), []):
+            if all(new_atom.args[i] == arg for i, arg in constants): # is_instance
+                # TODO: handle domain constants more intelligently
+                stream = self.streams[s_idx]
+                stamp = self._add_domain_atom(s_idx, d_idx, new_atom)
+                atoms = [self.atoms_from_domain[s_idx, d2_idx] if d_idx != d2_idx else [new_atom]
+                          for d2_idx in range(len(stream.domain))]
+                if not all(atoms):
+                    continue
+                if JOIN_DOMAINS:
+                    instances = self._get_combinations_join(s_idx, d_idx, new_atom, stamp)
+                else:
+                    instances = self._get_combinations(stream, [self._get_live_atoms(a) for a in atoms]) # Snapshot
                     #self._add_combinations_relation(stream, atoms)
+                lower_bound = self.complexity_from_atom[new_atom] + stream.get_complexity(num_calls=0)
+                self.push_cursor(stream, instances, lower_bound)
 
     def add_atom(self, atom, complexity):
         if not is_atom(atom):
@@ -123,5 +310,13 @@ class Instantiator(Sized): # Dynamic Instantiator
             assert self.complexity_from_atom[head] <= complexity
             return False
         self.complexity_from_atom[head] = complexity
+        self.stamp_from_atom[head] = self.num_domain_atoms
         self._add_new_instances(head)
         return True
+
+    def remove_atom(self, head):
+        # Instances already generated from head are not retracted; callers must check is_live
+        return self.complexity_from_atom.pop(head, None) is not None
+
+    def is_live(self, instance):
+        return all(head_from_fact(f) in self.complexity_from_atom for f in instance.get_domain())
@@ -1,23 +1,28 @@
 from __future__ import print_function
 
+from collections import OrderedDict, defaultdict, deque
+from heapq import heappush, heappop
 from itertools import product
 from copy import deepcopy, copy
 
+from pddlstream.algorithms.common import EvaluationCursor
+from pddlstream.algorithms.context import get_context
 from pddlstream.algorithms.instantiation import Instantiator
 from pddlstream.algorithms.scheduling.plan_streams import plan_streams
 from pddlstream.algorithms.scheduling.recover_streams import evaluations_from_stream_plan
 from pddlstream.algorithms.constraints import add_plan_constraints, PlanConstraints, WILD
 from pddlstream.language.constants import FAILED, INFEASIBLE, is_plan, str_from_plan, get_length
-from pddlstream.language.conversion import evaluation_from_fact, substitute_expression
+from pddlstream.language.conversion import evaluation_from_fact, substitute_expression, is_atom
 from pddlstream.language.function import FunctionResult, Function
 from pddlstream.language.stream import StreamResult, Result
 from pddlstream.language.statistics import check_effort, compute_plan_effort
 from pddlstream.language.object import Object, OptimisticObject
-from pddlstream.utils import INF, safe_zip, get_mapping, implies
+from pddlstream.utils import INF, safe_zip, get_mapping, implies, HeapElement
 
 CONSTRAIN_STREAMS = False
 CONSTRAIN_PLANS = False # TODO: might cause some strange effects on continuous_tamp
 MAX_DEPTH = INF # 1 | INF
+PERSISTENT_OPTIMISTIC = True # Maintains the optimistic results across iterations (see OptimisticClosure)
 
 def is_refined(stream_plan):
     # TODO: lazily expand the shared objects in some cases to prevent increase in size
@@ -62,6 +67,154 @@ def optimistic_process_streams(evaluations, streams, complexity_limit, **effort_
 
 ##################################################
 
+def get_instance_signature(instance):
+    # The optimistic results of an instance only change when one of these does
+    return instance.num_calls, instance.enumerated, instance.disabled, instance.opt_index
+
+class OptimisticClosure(object):
+    """
+    An incrementally maintained version of optimistic_process_streams.
+    Results are kept across calls. Instances whose signature changed (found through each stream's
+    updated_instances log), and everything that transitively depends on their facts, are deleted and rederived.
+    New evaluations and a raised complexity limit only process the new part of the queue.
+    """
+    def __init__(self, evaluations, streams):
+        self.evaluations = evaluations
+        self.streams = streams
+        self.instantiator = Instantiator(streams)
+        self.complexity_limit = 0
+        self.cursor = EvaluationCursor(evaluations)
+        self.num_deferred = 0
+        self.num_updated = {stream: len(stream.updated_instances) for stream in streams}
+        self.deferred = [] # Evaluations above the complexity limit
+        self.evaluation_atoms = set()
+        self.results_from_instance = OrderedDict() # Processed instances in processing order
+        self.signature_from_instance = {}
+        self.atoms_from_instance = {} # Atoms first added by the results of an instance
+        self.supporters_from_atom = defaultdict(set) # Instances with a result that certifies an atom
+        self.instances_from_atom = defaultdict(set) # Processed instances with an atom in their domain
+        self.results = [] # The results of results_from_instance in order (None once instances are deleted)
+    def is_valid(self, evaluations, streams, complexity_limit):
+        return (self.evaluations is evaluations) and (self.streams == streams) and \
+               (self.complexity_limit <= complexity_limit)
+    def _delete(self, instances, atoms):
+        # Over-deletes everything that depends on instances or atoms (returns the deleted instances)
+        deleted = []
+        queue = deque(instances)
+        def remove_atom(head):
+            if self.instantiator.remove_atom(head):
+                queue.extend(self.instances_from_atom.pop(head, []))
+                queue.extend(self.supporters_from_atom.pop(head, []))
+        for head in atoms:
+            remove_atom(head)
+        while queue:
+            instance = queue.popleft()
+            if instance not in self.results_from_instance:
+                continue
+            deleted.append(instance)
+            self.results = None
+            results = self.results_from_instance.pop(instance)
+            del self.signature_from_instance[instance]
+            for fact in instance.get_domain():
+                self.instances_from_atom[evaluation_from_fact(fact).head].discard(instance)
+            for result in results:
+                for fact in result.get_certified():
+                    self.supporters_from_atom[evaluation_from_fact(fact).head].discard(instance)
+            for head in self.atoms_from_instance.pop(instance):
+                if head not in self.evaluation_atoms:
+                    remove_atom(head)
+        return deleted
+    def _rederive(self, instances, atoms=[]):
+        for instance in self._delete(instances, atoms):
+            if self.instantiator.is_live(instance): # Otherwise regenerated when its domain is rederived
+                self.instantiator.push_instance(instance)
+    def _process_instance(self, instance):
+        complexity = self.instantiator.compute_complexity(instance)
+        results = []
+        new_atoms = []
+        for result in instance.next_optimistic():
+            new_facts = False
+            for fact in result.get_certified():
+                evaluation = evaluation_from_fact(fact)
+                self.supporters_from_atom[evaluation.head].add(instance)
+                if (evaluation.head not in self.evaluation_atoms) and \
+                        (complexity < self.instantiator.complexity_from_atom.get(evaluation.head, INF)):
+                    self._rederive([], [evaluation.head]) # Derived at a lower complexity than before
+                if (evaluation.head not in self.instantiator.complexity_from_atom) and \
+                        self.instantiator.add_atom(evaluation, complexity):
+                    new_atoms.append(evaluation.head)
+                    new_facts = True
+            if isinstance(result, FunctionResult) or new_facts:
+                results.append(result)
+        for fact in instance.get_domain():
+            self.instances_from_atom[evaluation_from_fact(fact).head].add(instance)
+        self.results_from_instance[instance] = results
+        if self.results is not None:
+            self.results.extend(results)
+        self.signature_from_instance[instance] = get_instance_signature(instance)
+        self.atoms_from_instance[instance] = new_atoms
+    def _get_changed(self):
+        # Processed instances whose signature changed since they were processed
+        updated = []
+        for stream in self.streams:
+            updated.extend(stream.updated_instances[self.num_updated[stream]:])
+            self.num_updated[stream] = len(stream.updated_instances)
+        return [instance for instance in OrderedDict.fromkeys(updated)
+                if (instance in self.signature_from_instance) and
+                (get_instance_signature(instance) != self.signature_from_instance[instance])]
+    def _is_pending(self, instance):
+        return (instance not in self.results_from_instance) and self.instantiator.is_live(instance)
+    def update(self, evaluations, complexity_limit):
+        assert self.is_valid(evaluations, self.streams, complexity_limit)
+        self.complexity_limit = complexity_limit
+        removed_evaluations, added_evaluations = self.cursor.update()
+        removed_atoms = [evaluation.head for evaluation in removed_evaluations
+                         if evaluation.head in self.evaluation_atoms]
+        self.evaluation_atoms.difference_update(removed_atoms)
+        for evaluation in added_evaluations:
+            heappush(self.deferred, HeapElement((evaluations[evaluation].complexity, self.num_deferred), evaluation))
+            self.num_deferred += 1
+        new_evaluations = []
+        while self.deferred and (self.deferred[0].key[0] <= complexity_limit):
+            (complexity, _), evaluation = heappop(self.deferred)
+            node = evaluations.get(evaluation, None)
+            if (node is not None) and (node.complexity == complexity) and is_atom(evaluation): # Otherwise removed
+                new_evaluations.append((evaluation, complexity))
+
+        changed = self._get_changed()
+        optimistic_atoms = [evaluation.head for evaluation, _ in new_evaluations
+                            if evaluation.head in self.instantiator.complexity_from_atom]
+        self._rederive(changed, removed_atoms + optimistic_atoms)
+        for evaluation, complexity in new_evaluations:
+            self.evaluation_atoms.add(evaluation.head)
+            self.instantiator.add_atom(evaluation, complexity)
+
+        while self.instantiator and (self.instantiator.min_complexity() <= complexity_limit):
+            instance = self.instantiator.pop_stream()
+            if not self._is_pending(instance):
+                continue
+            if complexity_limit < self.instantiator.compute_complexity(instance):
+                self.instantiator.push_instance(instance) # Stale priority (num_calls increased)
+                continue
+            self._process_instance(instance)
+        while self.instantiator and not self._is_pending(self.instantiator.peek_stream()):
+            self.instantiator.pop_stream()
+        if self.results is None:
+            self.results = [result for results in self.results_from_instance.values() for result in results]
+        exhausted = not self.instantiator
+        return list(self.results), exhausted
+
+def persistent_process_streams(evaluations, streams, complexity_limit, **effort_args):
+    # Same as optimistic_process_streams but reuses the OptimisticClosure of the previous call
+    optimistic_streams = prune_high_effort_streams(streams, **effort_args)
+    caches = get_context().caches
+    closure = caches.get(OptimisticClosure, None)
+    if (closure is None) or not closure.is_valid(evaluations, optimistic_streams, complexity_limit):
+        closure = caches[OptimisticClosure] = OptimisticClosure(evaluations, optimistic_streams)
+    return closure.update(evaluations, complexity_limit)
+
+##################################################
+
 def optimistic_stream_instantiation(instance, bindings, evaluations, opt_evaluations,
                                     only_immediate=False):
     # TODO: combination for domain predicates
@@ -189,7 +342,10 @@ def iterative_plan_streams(all_evaluations, externals, optimistic_solve_fn, comp
     num_iterations = 0
     while True:
         num_iterations += 1
-        results, exhausted = optimistic_process_streams(complexity_evals, externals, complexity_limit, **effort_args)
+        if PERSISTENT_OPTIMISTIC:
+            results, exhausted = persistent_process_streams(all_evaluations, externals, complexity_limit, **effort_args)
+        else:
+            results, exhausted = optimistic_process_streams(complexity_evals, externals, complexity_limit, **effort_args)
         stream_plan, action_plan, cost, final_depth = hierarchical_plan_streams(
             complexity_evals, externals, results, optimistic_solve_fn, complexity_limit,
             depth=0, constraints=None, **effort_args)
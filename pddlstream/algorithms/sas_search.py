@@ -0,0 +1,288 @@
+from __future__ import print_function
+
+from collections import defaultdict
+from heapq import heappush, heappop
+from itertools import count
+from time import time
+
+from pddlstream.algorithms.downward import DEFAULT_PLANNER, DEFAULT_MAX_TIME, PORTFOLIO_TIME, get_cost_scale, \
+    scale_cost, parse_action, is_portfolio, has_fd_build
+from pddlstream.utils import INF, elapsed_time
+
+# In-process search directly on a translated SASTask (no serialization or FastDownward process)
+# Intended for the small optimistic tasks produced by plan_streams, where process overhead dominates
+
+# Opt-in because the search only approximates FastDownward's configurations (e.g. no preferred operators or lazy search)
+MAX_PYTHON_OPERATORS = 0 # Tasks with at most this many operators + axioms are searched in-process (0 disables)
+TIME_CHECK_PERIOD = 100 # Number of expansions between timeout checks
+
+BLIND, GOAL_COUNT, H_MAX, H_ADD, H_FF = 'blind', 'goal', 'max', 'add', 'ff'
+
+##################################################
+
+def use_python_search(sas_task):
+    # Also used whenever FastDownward is not built
+    if not has_fd_build():
+        return True
+    return (len(sas_task.operators) + len(sas_task.axioms)) <= MAX_PYTHON_OPERATORS
+
+def get_search_config(planner):
+    # Approximates the SEARCH_OPTIONS configuration of the same name: (heuristic, weight)
+    # weight=None is greedy best-first search; otherwise f = g + weight*h
+    if planner == 'dijkstra':
+        return BLIND, 1
+    heuristic_name = planner.split('-')[0]
+    heuristic = {
+        'max': H_MAX,
+        'lmcut': H_MAX, # Admissible substitute
+        'add': H_ADD,
+        'cea': H_ADD,
+        'goal': GOAL_COUNT,
+    }.get(heuristic_name, H_FF)
+    if '-wastar' in planner:
+        return heuristic, int(planner.split('-wastar')[1])
+    if planner.endswith('-astar'):
+        return heuristic, 1
+    return heuristic, None
+
+##################################################
+
+class SASStateSpace(object):
+    """
+    Compact integer encoding of a SASTask.
+    States are tuples of variable values and facts (var, val) are flattened into consecutive integers.
+    """
+    def __init__(self, sas_task):
+        self.task = sas_task
+        ranges = sas_task.variables.ranges
+        self.axiom_layers = sas_task.variables.axiom_layers
+        self.offsets = []
+        num_facts = 0
+        for var_range in ranges:
+            self.offsets.append(num_facts)
+            num_facts += var_range
+        self.num_facts = num_facts
+        self.goal = list(sas_task.goal.pairs)
+        self.goal_facts = [self.fact_id(var, val) for var, val in self.goal]
+        self.costs = [op.cost if sas_task.metric else 1 for op in sas_task.operators]
+
+        self.derived_defaults = {var: sas_task.init.values[var] for var, layer in enumerate(self.axiom_layers)
+                                 if layer >= 0} # Derived variables are reset to their default each state
+        self.axioms_from_layer = defaultdict(list)
+        for axiom in sas_task.axioms:
+            var, _ = axiom.effect
+            self.axioms_from_layer[self.axiom_layers[var]].append(axiom)
+        self.layers = sorted(self.axioms_from_layer)
+
+        self.preconditions = []
+        for op in sas_task.operators:
+            preconditions = list(op.prevail) + [(var, pre) for var, pre, _, _ in op.pre_post if pre != -1]
+            self.preconditions.append(preconditions)
+        self.init = self.evaluate_axioms(list(sas_task.init.values))
+    def fact_id(self, var, val):
+        return self.offsets[var] + val
+    def evaluate_axioms(self, values):
+        if not self.derived_defaults:
+            return tuple(values)
+        for var, default in self.derived_defaults.items():
+            values[var] = default
+        for layer in self.layers:
+            changed = True
+            while changed: # Naive fixed point (tasks are small)
+                changed = False
+                for axiom in self.axioms_from_layer[layer]:
+                    var, val = axiom.effect
+                    if (values[var] != val) and all(values[v] == d for v, d in axiom.condition):
+                        values[var] = val
+                        changed = True
+        return tuple(values)
+    def is_goal(self, state):
+        return all(state[var] == val for var, val in self.goal)
+    def get_successors(self, state):
+        for index, op in enumerate(self.task.operators):
+            if not all(state[var] == val for var, val in self.preconditions[index]):
+                continue
+            values = list(state)
+            for var, _, post, cond in op.pre_post:
+                if all(state[v] == d for v, d in cond):
+                    values[var] = post
+            yield index, self.evaluate_axioms(values)
+
+##################################################
+
+class RelaxedHeuristic(object):
+    """
+    h_max, h_add, and h_ff computed over unary relaxed operators.
+    Axioms are zero-cost operators and the default values of derived variables are always reachable,
+    which keeps the relaxation complete in the presence of negated axioms.
+    """
+    def __init__(self, state_space, heuristic=H_FF):
+        self.state_space = state_space
+        self.heuristic = heuristic
+        self.combine = max if heuristic == H_MAX else sum
+        task = state_space.task
+        fact_id = state_space.fact_id
+        self.unary_pre = []
+        self.unary_eff = []
+        self.unary_cost = []
+        self.unary_op = [] # Index of the original operator (None for axioms)
+        def add_unary(preconditions, effect, cost, op_index):
+            self.unary_pre.append(tuple(sorted({fact_id(var, val) for var, val in preconditions})))
+            self.unary_eff.append(fact_id(*effect))
+            self.unary_cost.append(cost)
+            self.unary_op.append(op_index)
+        for op_index, op in enumerate(task.operators):
+            preconditions = state_space.preconditions[op_index]
+            for var, _, post, cond in op.pre_post:
+                add_unary(preconditions + list(cond), (var, post), state_space.costs[op_index], op_index)
+        for axiom in task.axioms:
+            add_unary(axiom.condition, axiom.effect, 0, None)
+        self.unary_from_fact = [[] for _ in range(state_space.num_facts)]
+        for index, preconditions in enumerate(self.unary_pre):
+            for fact in preconditions:
+                self.unary_from_fact[fact].append(index)
+        self.no_pre = [index for index, preconditions in enumerate(self.unary_pre) if not preconditions]
+        self.default_facts = [fact_id(var, val) for var, val in state_space.derived_defaults.items()]
+    def explore(self, state):
+        fact_costs = [INF]*self.state_space.num_facts
+        achievers = [None]*self.state_space.num_facts
+        remaining = [len(preconditions) for preconditions in self.unary_pre]
+        pre_costs = [0]*len(self.unary_pre)
+        queue = []
+        def relax(fact, cost, achiever):
+            if cost < fact_costs[fact]:
+                fact_costs[fact] = cost
+                achievers[fact] = achiever
+                heappush(queue, (cost, fact))
+        for var, val in enumerate(state):
+            relax(self.state_space.fact_id(var, val), 0, None)
+        for fact in self.default_facts:
+            relax(fact, 0, None)
+        for index in self.no_pre:
+            relax(self.unary_eff[index], self.unary_cost[index], index)
+        unreached_goals = set(self.state_space.goal_facts)
+        while queue and unreached_goals:
+            cost, fact = heappop(queue)
+            if fact_costs[fact] < cost:
+                continue
+            unreached_goals.discard(fact)
+            for index in self.unary_from_fact[fact]:
+                pre_costs[index] = self.combine([pre_costs[index], cost])
+                remaining[index] -= 1
+                if remaining[index] == 0:
+                    relax(self.unary_eff[index], self.unary_cost[index] + pre_costs[index], index)
+        return fact_costs, achievers
+    def extract_relaxed_plan(self, achievers):
+        relaxed_plan = set() # Distinct original operators
+        reached = set()
+        stack = list(self.state_space.goal_facts)
+        while stack:
+            fact = stack.pop()
+            if fact in reached:
+                continue
+            reached.add(fact)
+            index = achievers[fact]
+            if index is None:
+                continue
+            if self.unary_op[index] is not None:
+                relaxed_plan.add(self.unary_op[index])
+            stack.extend(self.unary_pre[index])
+        return sum(self.state_space.costs[op_index] for op_index in relaxed_plan)
+    def __call__(self, state):
+        if self.heuristic == BLIND:
+            return 0
+        if self.heuristic == GOAL_COUNT:
+            return sum(state[var] != val for var, val in self.state_space.goal)
+        fact_costs, achievers = self.explore(state)
+        goal_costs = [fact_costs[fact] for fact in self.state_space.goal_facts]
+        if INF in goal_costs:
+            return INF
+        if self.heuristic == H_FF:
+            return self.extract_relaxed_plan(achievers)
+        return self.combine([0] + goal_costs)
+
+##################################################
+
+def retrace_plan(parent_from_state, state):
+    op_indices = []
+    while parent_from_state[state] is not None:
+        state, op_index = parent_from_state[state]
+        op_indices.append(op_index)
+    return op_indices[::-1]
+
+def python_portfolio(sas_task, planners, max_planner_time=DEFAULT_MAX_TIME, portfolio_time=PORTFOLIO_TIME,
+                     **search_args):
+    # Runs each configuration in turn (run_portfolio runs them concurrently) with the same semantics for portfolio_time
+    start_time = time()
+    best_plan, best_cost = None, INF
+    for planner in planners:
+        max_time = max_planner_time if portfolio_time is None else \
+            min(max_planner_time, portfolio_time - elapsed_time(start_time))
+        if max_time <= 0:
+            break
+        plan, cost = python_search(sas_task, planner=planner, max_planner_time=max_time, **search_args)
+        if cost < best_cost:
+            best_plan, best_cost = plan, cost
+        if (best_plan is not None) and (portfolio_time is None):
+            break
+    return best_plan, best_cost
+
+def python_search(sas_task, planner=DEFAULT_PLANNER, max_planner_time=DEFAULT_MAX_TIME, max_cost=INF,
+                  debug=False, **kwargs):
+    # Returns the same (plan, cost) as run_search
+    if is_portfolio(planner):
+        return python_portfolio(sas_task, planner, max_planner_time=max_planner_time, max_cost=max_cost,
+                                debug=debug, **kwargs)
+    start_time = time()
+    heuristic_name, weight = get_search_config(planner)
+    state_space = SASStateSpace(sas_task)
+    heuristic = RelaxedHeuristic(state_space, heuristic_name)
+    bound = INF if max_cost == INF else scale_cost(max_cost) # Exclusive (like FastDownward)
+    def priority(g, h):
+        return h if weight is None else (g + weight*h)
+
+    init = state_space.init
+    parent_from_state = {init: None}
+    g_from_state = {init: 0}
+    h_from_state = {init: heuristic(init)}
+    tiebreaker = count()
+    queue = [(priority(0, h_from_state[init]), next(tiebreaker), init)]
+    closed = set()
+    num_expanded = 0
+    plan, cost = None, INF
+    while queue:
+        if (num_expanded % TIME_CHECK_PERIOD == 0) and (max_planner_time <= elapsed_time(start_time)):
+            break
+        _, _, state = heappop(queue)
+        if state in closed:
+            continue
+        closed.add(state)
+        g = g_from_state[state]
+        if state_space.is_goal(state):
+            op_indices = retrace_plan(parent_from_state, state)
+            plan = [parse_action(sas_task.operators[index].name) for index in op_indices]
+            cost = float(g) / get_cost_scale()
+            break
+        num_expanded += 1
+        for op_index, successor in state_space.get_successors(state):
+            successor_g = g + state_space.costs[op_index]
+            if bound <= successor_g:
+                continue
+            if successor_g < g_from_state.get(successor, INF):
+                if (successor in closed) and (weight is None):
+                    continue # Greedy search does not reopen
+                closed.discard(successor)
+                g_from_state[successor] = successor_g
+                parent_from_state[successor] = (state, op_index)
+                if successor not in h_from_state:
+                    h_from_state[successor] = heuristic(successor)
+                h = h_from_state[successor]
+                if h == INF:
+                    continue
+                heappush(queue, (priority(successor_g, h), next(tiebreaker), successor))
+    if debug:
+        print('Python search | Planner: {} | Heuristic: {} | Weight: {} | Operators: {} | Axioms: {} | '
+              'Expanded: {} | Generated: {} | Cost: {} | Time: {:.3f}'.format(
+            planner, heuristic_name, weight, len(sas_task.operators), len(sas_task.axioms),
+            num_expanded, len(g_from_state), cost, elapsed_time(start_time)))
+    return plan, cost
@@ -1,3 +1,4 @@
+from pddlstream.algorithms.bitset import AtomIndex, BitState
 from pddlstream.algorithms.downward import fact_from_fd, plan_preimage, apply_action, \
     GOAL_NAME, get_derived_predicates, literal_holds
 from pddlstream.algorithms.scheduling.recover_axioms import extract_axiom_plan
@@ -65,7 +66,7 @@ def recover_negative_axioms(real_task, opt_task, axiom_plans, action_plan, negat
 
     # TODO: could instead just accumulate difference between real and opt
     opt_task.init = set(opt_task.init)
-    real_states = [set(real_task.init)]
+    real_states = [BitState(AtomIndex(), real_task.init)] # Copying a bitset is constant time
     preimage_plan = []
     for axiom_plan, action_instance in safe_zip(axiom_plans, action_plan):
         preimage = [l for l in plan_preimage(axiom_plan + [action_instance])
@@ -79,6 +80,6 @@ def recover_negative_axioms(real_task, opt_task, axiom_plans, action_plan, negat
         preimage_plan.extend(negative_axiom_plan + axiom_plan + [action_instance])
         if action_instance.name != GOAL_NAME:
             apply_action(opt_task.init, action_instance)
-            real_states.append(set(real_states[-1]))
+            real_states.append(real_states[-1].copy())
             apply_action(real_states[-1], action_instance)
     return real_states, preimage_plan
@@ -1,5 +1,6 @@
 from collections import defaultdict
 
+from pddlstream.algorithms.bitset import AtomIndex, BitState
 from pddlstream.algorithms.downward import get_literals, apply_action, \
     get_derived_predicates, literal_holds, GOAL_NAME, get_precondition
 from pddlstream.algorithms.instantiate_task import get_goal_instance, filter_negated, get_achieving_axioms
@@ -172,7 +173,7 @@ def recover_axioms_plans(instantiated, action_instances):
     for axiom in axioms:
         axioms_from_effect[axiom.effect].append(axiom)
 
-    state = set(instantiated.task.init) | set(axiom_init)
+    state = BitState(AtomIndex(), set(instantiated.task.init) | set(axiom_init))
     axiom_plans = []
     for action in action_instances + [get_goal_instance(instantiated.task.goal)]:
         all_conditions = list(get_precondition(action)) + list(flatten(cond for cond, _ in action.add_effects + action.del_effects))
@@ -1,11 +1,12 @@
 from __future__ import print_function
 
-from copy import deepcopy
+from copy import copy
 from time import time
 
 from pddlstream.language.temporal import solve_tfd
-from pddlstream.algorithms.downward import parse_solution, run_search, TEMP_DIR, write_pddl
-from pddlstream.algorithms.instantiate_task import write_sas_task, sas_from_pddl, translate_and_write_pddl
+from pddlstream.algorithms.downward import parse_solution, run_search, get_temp_dir, write_pddl
+from pddlstream.algorithms.instantiate_task import serialize_sas_task, sas_from_pddl, translate_pddl
+from pddlstream.algorithms.sas_search import use_python_search, python_search
 from pddlstream.utils import INF, Verbose, safe_rm_dir
 
 # TODO: manual_patterns
@@ -16,16 +17,21 @@ from pddlstream.utils import INF, Verbose, safe_rm_dir
 # TODO: recursive application of these
 # TODO: write the domain and problem PDDL files that are used for debugging purposes
 
-def solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], **search_args):
+def search_sas_task(sas_task, debug=False, serialized=None, **search_args):
+    # Small tasks are searched in-process, avoiding serialization and FastDownward altogether
+    if use_python_search(sas_task):
+        return python_search(sas_task, debug=debug, **search_args)
+    return run_search(serialize_sas_task(sas_task, serialized=serialized), debug=debug, **search_args)
+
+def solve_from_task(sas_task, temp_dir=None, clean=False, debug=False, hierarchy=[], **search_args):
     # TODO: can solve using another planner and then still translate using FastDownward
     # Can apply plan constraints (skeleton constraints) here as well
     start_time = time()
     with Verbose(debug):
         print('\n' + 50*'-' + '\n')
-        write_sas_task(sas_task, temp_dir)
-        solution = run_search(temp_dir, debug=True, **search_args)
+        solution = search_sas_task(sas_task, debug=True, **search_args)
         if clean:
-            safe_rm_dir(temp_dir)
+            safe_rm_dir(get_temp_dir(temp_dir))
         print('Total runtime:', time() - start_time)
     #for axiom in sas_task.axioms:
     #    # TODO: return the set of axioms here as well
@@ -34,22 +40,33 @@ def solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hiera
     #    axiom.dump()
     return solution
 
-def solve_from_pddl(domain_pddl, problem_pddl, temp_dir=TEMP_DIR, clean=False, debug=False, **search_args):
+def solve_from_pddl(domain_pddl, problem_pddl, temp_dir=None, clean=False, debug=False, **search_args):
     # TODO: combine with solve_from_task
     #return solve_tfd(domain_pddl, problem_pddl)
     start_time = time()
     with Verbose(debug):
         write_pddl(domain_pddl, problem_pddl, temp_dir)
         #run_translate(temp_dir, verbose)
-        translate_and_write_pddl(domain_pddl, problem_pddl, temp_dir, debug)
-        solution = run_search(temp_dir, debug=debug, **search_args)
+        sas_task = translate_pddl(domain_pddl, problem_pddl)
+        solution = search_sas_task(sas_task, debug=debug, **search_args)
         if clean:
-            safe_rm_dir(temp_dir)
+            safe_rm_dir(get_temp_dir(temp_dir))
         print('Total runtime:', time() - start_time)
     return solution
 
 ##################################################
 
+def copy_sas_task(sas_task):
+    # Copy-on-write: the init and goal are copied, while the variables, mutexes, operators, and axioms
+    # are shared with sas_task until replaced (see prune_hierarchy_pre_eff and add_subgoals)
+    new_task = copy(sas_task)
+    new_task.init = copy(sas_task.init)
+    new_task.init.values = list(sas_task.init.values)
+    new_task.goal = copy(sas_task.goal)
+    new_task.goal.pairs = list(sas_task.goal.pairs)
+    new_task.operators = list(sas_task.operators)
+    return new_task
+
 def apply_sas_operator(init, op):
     for var, pre, post, cond in op.pre_post:
         assert (pre == -1) or (init.values[var] == pre)
@@ -72,13 +89,15 @@ def parse_sas_plan(sas_task, plan):
 
 SERIALIZE = 'serialize'
 
-def plan_subgoals(sas_task, subgoal_plan, temp_dir, **kwargs):
+def plan_subgoals(sas_task, subgoal_plan, temp_dir, serialized=None, **kwargs):
+    sas_task = copy_sas_task(sas_task) # Only the init and goal change between subgoals
+    if serialized is None:
+        serialized = {}
     full_plan = []
     full_cost = 0
     for subgoal in subgoal_plan:
-        sas_task.goal.pairs = subgoal
-        write_sas_task(sas_task, temp_dir)
-        plan, cost = run_search(temp_dir, debug=True, **kwargs)
+        sas_task.goal.pairs = list(subgoal)
+        plan, cost = search_sas_task(sas_task, debug=True, serialized=serialized, **kwargs)
         if plan is None:
             return None, INF
         full_plan.extend(plan)
@@ -88,7 +107,7 @@ def plan_subgoals(sas_task, subgoal_plan, temp_dir, **kwargs):
     return full_plan, full_cost
 
 
-def serialized_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], **kwargs):
+def serialized_solve_from_task(sas_task, temp_dir=None, clean=False, debug=False, hierarchy=[], **kwargs):
     # TODO: specify goal grouping / group by predicate & objects
     # TODO: version that solves for all disjuctive subgoals at once
     start_time = time()
@@ -97,7 +116,7 @@ def serialized_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=F
         subgoal_plan = [sas_task.goal.pairs[:i+1] for i in range(len(sas_task.goal.pairs))]
         plan, cost = plan_subgoals(sas_task, subgoal_plan, temp_dir, **kwargs)
         if clean:
-            safe_rm_dir(temp_dir)
+            safe_rm_dir(get_temp_dir(temp_dir))
         print('Total runtime:', time() - start_time)
     return plan, cost
 
@@ -130,25 +149,27 @@ def prune_hierarchy_pre_eff(sas_task, layers):
         for val, name in enumerate(names):
             if any(name.startswith(p) for p in pruned_pre):
                 pruned.add((var, val))
-    for op in sas_task.operators:
-        for k, pair in reversed(list(enumerate(op.prevail))):
-            if pair in pruned:
-                op.prevail.pop(0)
-    for k, pair in reversed(list(enumerate(sas_task.goal.pairs))):
-        if pair in pruned:
-            sas_task.goal.pairs.pop(0)
+    # Assumes sas_task is a copy_sas_task (operators are replaced rather than modified)
+    for i, op in enumerate(sas_task.operators):
+        if any(pair in pruned for pair in op.prevail):
+            sas_task.operators[i] = copy(op)
+            sas_task.operators[i].prevail = [pair for pair in op.prevail if pair not in pruned]
+    sas_task.goal.pairs = [pair for pair in sas_task.goal.pairs if pair not in pruned]
     return pruned
 
 
 def add_subgoals(sas_task, subgoal_plan):
     if not subgoal_plan:
         return None
+    # Assumes sas_task is a copy_sas_task (the variables and operators are replaced rather than modified)
     subgoal_var = len(sas_task.variables.ranges)
     subgoal_range = len(subgoal_plan) + 1
-    sas_task.variables.ranges.append(subgoal_range)
-    sas_task.variables.axiom_layers.append(-1)
-    sas_task.variables.value_names.append(
-        ['subgoal{}'.format(i) for i in range(subgoal_range)])
+    variables = copy(sas_task.variables)
+    variables.ranges = variables.ranges + [subgoal_range]
+    variables.axiom_layers = variables.axiom_layers + [-1]
+    variables.value_names = variables.value_names + [
+        ['subgoal{}'.format(i) for i in range(subgoal_range)]]
+    sas_task.variables = variables
     sas_task.init.values.append(0)
     sas_task.goal.pairs.append((subgoal_var, subgoal_range - 1))
 
@@ -158,7 +179,8 @@ def add_subgoals(sas_task, subgoal_plan):
             continue
         subgoal = subgoal_plan.index(op.name) + 1
         pre_post = (subgoal_var, subgoal - 1, subgoal, [])
-        op.pre_post.append(pre_post)
+        sas_task.operators[i] = copy(op)
+        sas_task.operators[i].pre_post = op.pre_post + [pre_post]
         # TODO: maybe this should be the resultant state instead?
         # TODO: prevail should just be the last prevail
         # name = '(subgoal{}_{})'.format(subgoal, i)
@@ -168,7 +190,7 @@ def add_subgoals(sas_task, subgoal_plan):
     return subgoal_var
 
 
-def abstrips_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False, hierarchy=[], **kwargs):
+def abstrips_solve_from_task(sas_task, temp_dir=None, clean=False, debug=False, hierarchy=[], **kwargs):
     # Like partial order planning in terms of precondition order
     # TODO: add achieve subgoal actions
     # TODO: most generic would be a heuristic on each state
@@ -181,18 +203,18 @@ def abstrips_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=Fal
     with Verbose(debug):
         print('\n' + 50*'-' + '\n')
         last_plan = []
+        serialized = {} # Unmodified operators and axioms are only serialized once
         for level in range(len(hierarchy)+1):
-            local_sas_task = deepcopy(sas_task)
+            local_sas_task = copy_sas_task(sas_task)
             prune_hierarchy_pre_eff(local_sas_task, hierarchy[level:]) # TODO: break if no pruned
             add_subgoals(local_sas_task, last_plan)
-            write_sas_task(local_sas_task, temp_dir)
-            plan, cost = run_search(temp_dir, debug=True, **kwargs)
+            plan, cost = search_sas_task(local_sas_task, debug=True, serialized=serialized, **kwargs)
             if (level == len(hierarchy)) or (plan is None):
                 # TODO: fall back on standard search
                 break
             last_plan = [name_from_action(action, args) for action, args in plan]
         if clean:
-            safe_rm_dir(temp_dir)
+            safe_rm_dir(get_temp_dir(temp_dir))
         print('Total runtime:', time() - start_time)
     return plan, cost
 
@@ -202,7 +224,7 @@ def abstrips_solve_from_task(sas_task, temp_dir=TEMP_DIR, clean=False, debug=Fal
 # TODO: reconcile shared objects on each level
 # Each operator in the hierarchy is a legal "operator" that may need to be refined
 
-def abstrips_solve_from_task_sequential(sas_task, temp_dir=TEMP_DIR, clean=False, debug=False,
+def abstrips_solve_from_task_sequential(sas_task, temp_dir=None, clean=False, debug=False,
                                         hierarchy=[], subgoal_horizon=1, **kwargs):
     # TODO: version that plans for each goal individually
     # TODO: can reduce to goal serialization if binary flag for each subgoal
@@ -212,8 +234,9 @@ def abstrips_solve_from_task_sequential(sas_task, temp_dir=TEMP_DIR, clean=False
     plan, cost = None, INF
     with Verbose(debug):
         last_plan = None
+        serialized = {}
         for level in range(len(hierarchy) + 1):
-            local_sas_task = deepcopy(sas_task)
+            local_sas_task = copy_sas_task(sas_task)
             prune_hierarchy_pre_eff(local_sas_task, hierarchy[level:])  # TODO: break if no pruned
             # The goal itself is effectively a subgoal
             # Handle this subgoal horizon
@@ -225,14 +248,14 @@ def abstrips_solve_from_task_sequential(sas_task, temp_dir=TEMP_DIR, clean=False
                     local_sas_task.variables.ranges[subgoal_var], subgoal_horizon)] + subgoal_plan
                 hierarchy_horizon = min(hierarchy[level-1].horizon, len(subgoal_plan))
                 subgoal_plan = subgoal_plan[:hierarchy_horizon]
-            plan, cost = plan_subgoals(local_sas_task, subgoal_plan, temp_dir, **kwargs)
+            plan, cost = plan_subgoals(local_sas_task, subgoal_plan, temp_dir, serialized=serialized, **kwargs)
             if (level == len(hierarchy)) or (plan is None):
                 # TODO: fall back on normal
                 # TODO: search in space of subgoals
                 break
             last_plan = [name_from_action(action, args) for action, args in plan]
         if clean:
-            safe_rm_dir(temp_dir)
+            safe_rm_dir(get_temp_dir(temp_dir))
         print('Total runtime:', time() - start_time)
     # TODO: record which level of abstraction each operator is at when returning
     # TODO: return instantiated actions here rather than names (including pruned pre/eff)
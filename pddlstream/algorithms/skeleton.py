@@ -41,6 +41,7 @@ def compute_affected(stream_plan, index):
     return Affected(affected_indices, has_cost)
 
 class Skeleton(object):
+    __slots__ = ('index', 'queue', 'stream_plan', 'action_plan', 'cost', 'best_binding', 'root', 'affected_indices')
     def __init__(self, queue, stream_plan, action_plan, cost):
         self.index = len(queue.skeletons)
         queue.skeletons.append(self)
@@ -57,6 +58,8 @@ class Skeleton(object):
 ##################################################
 
 class Binding(object):
+    __slots__ = ('skeleton', 'cost', 'history', 'mapping', 'index', 'children', '_result', 'attempts', 'calls',
+                 'complexity', 'max_history')
     def __init__(self, skeleton, cost, history, mapping, index):
         self.skeleton = skeleton
         self.cost = cost
@@ -1,7 +1,6 @@
 from __future__ import print_function
 
-import os
-
+from pddlstream.algorithms.context import get_context, VISUALIZATIONS_DIR
 from pddlstream.algorithms.reorder import get_partial_orders
 from pddlstream.language.constants import EQ, get_prefix, get_args, str_from_plan, is_parameter, \
     partition_facts
@@ -19,10 +18,10 @@ COST_COLOR = 'LightSalmon'
 STREAM_COLOR = 'LightSteelBlue'
 FUNCTION_COLOR = 'LightCoral'
 
-VISUALIZATIONS_DIR = 'visualizations/'
-CONSTRAINT_NETWORK_DIR = os.path.join(VISUALIZATIONS_DIR, 'constraint_networks/')
-STREAM_PLAN_DIR = os.path.join(VISUALIZATIONS_DIR, 'stream_plans/')
-PLAN_LOG_FILE = os.path.join(VISUALIZATIONS_DIR, 'log.txt')
+# Relative to the visualizations directory of the active SolverContext (VISUALIZATIONS_DIR by default)
+CONSTRAINT_NETWORK_DIR = 'constraint_networks/'
+STREAM_PLAN_DIR = 'stream_plans/'
+PLAN_LOG_FILE = 'log.txt'
 ITERATION_TEMPLATE = 'iteration_{}.png'
 SYNTHESIZER_TEMPLATE = '{}_{}.png'
 
@@ -35,16 +34,19 @@ def has_pygraphviz():
         return False
     return True
 
+def get_visualization_path(*paths):
+    return get_context().get_visualization_path(*paths)
+
 def reset_visualizations():
-    clear_dir(VISUALIZATIONS_DIR)
-    ensure_dir(CONSTRAINT_NETWORK_DIR)
-    ensure_dir(STREAM_PLAN_DIR)
+    clear_dir(get_visualization_path())
+    ensure_dir(get_visualization_path(CONSTRAINT_NETWORK_DIR))
+    ensure_dir(get_visualization_path(STREAM_PLAN_DIR))
 
 def log_plans(stream_plan, action_plan, iteration):
     # TODO: do this within the focused algorithm itself?
     from pddlstream.retired.synthesizer import decompose_stream_plan
     decomposed_plan = decompose_stream_plan(stream_plan)
-    with open(PLAN_LOG_FILE, 'a+') as f:
+    with open(get_visualization_path(PLAN_LOG_FILE), 'a+') as f:
         f.write('Iteration: {}\n'
                 'Component plan: {}\n'
                 'Stream plan: {}\n'
@@ -59,8 +61,8 @@ def create_synthesizer_visualizations(result, iteration):
         return
     # TODO: may overwrite another optimizer if both used on the same iteration
     filename = SYNTHESIZER_TEMPLATE.format(result.external.name, iteration)
-    visualize_constraints(result.get_objectives(), os.path.join(CONSTRAINT_NETWORK_DIR, filename))
-    visualize_stream_plan_bipartite(stream_plan, os.path.join(STREAM_PLAN_DIR, filename))
+    visualize_constraints(result.get_objectives(), get_visualization_path(CONSTRAINT_NETWORK_DIR, filename))
+    visualize_stream_plan_bipartite(stream_plan, get_visualization_path(STREAM_PLAN_DIR, filename))
 
 def create_visualizations(evaluations, stream_plan, iteration):
     # TODO: place it in the temp_dir?
@@ -74,12 +76,12 @@ def create_visualizations(evaluations, stream_plan, iteration):
     for stream in stream_plan:
         constraints.update(filter(lambda f: evaluation_from_fact(f) not in evaluations, stream.get_certified()))
     print('Constraints:', str_from_object(constraints))
-    visualize_constraints(constraints, os.path.join(CONSTRAINT_NETWORK_DIR, filename))
+    visualize_constraints(constraints, get_visualization_path(CONSTRAINT_NETWORK_DIR, filename))
     decomposed_plan = decompose_stream_plan(stream_plan)
     if len(decomposed_plan) != len(stream_plan):
-        visualize_stream_plan(decompose_stream_plan(stream_plan), os.path.join(STREAM_PLAN_DIR, filename))
-    #visualize_stream_plan_bipartite(stream_plan, os.path.join(STREAM_PLAN_DIR, 'fused_' + filename))
-    visualize_stream_plan(stream_plan, os.path.join(STREAM_PLAN_DIR, 'fused_' + filename))
+        visualize_stream_plan(decompose_stream_plan(stream_plan), get_visualization_path(STREAM_PLAN_DIR, filename))
+    #visualize_stream_plan_bipartite(stream_plan, get_visualization_path(STREAM_PLAN_DIR, 'fused_' + filename))
+    visualize_stream_plan(stream_plan, get_visualization_path(STREAM_PLAN_DIR, 'fused_' + filename))
 
 ##################################################
 
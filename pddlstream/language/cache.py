@@ -0,0 +1,130 @@
+from __future__ import print_function
+
+import os
+import pickle
+import threading
+
+from collections import OrderedDict
+
+from pddlstream.utils import read_pickle, ensure_dir, hash_content
+
+# Persistent memoization of stream outputs across runs (see StreamInfo(cache=True))
+# The outputs of an instance are recorded per call and replayed by later runs before calling the generator
+
+MAX_CACHE_ENTRIES = 10000 # Maximum number of instances recorded per stream
+MAX_CACHE_BYTES = 100*1024**2 # Maximum number of bytes recorded per stream
+
+try:
+    STABLE_TYPES = (type(None), bool, int, long, float, complex, str, unicode) # Python 2
+except NameError:
+    STABLE_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+class UncacheableValue(TypeError):
+    pass
+
+##################################################
+
+def get_content(value):
+    # A canonical form of value that does not depend on object ids or hash randomization
+    # Values of other types (whose repr may contain an id) raise UncacheableValue
+    if isinstance(value, (tuple, list)):
+        return (value.__class__.__name__,) + tuple(map(get_content, value))
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted(((get_content(k), get_content(v)) for k, v in value.items()), key=repr))
+    if isinstance(value, (set, frozenset)):
+        return ('set',) + tuple(sorted(map(get_content, value), key=repr))
+    if hasattr(value, 'tobytes') and hasattr(value, 'dtype'): # numpy.ndarray
+        return (value.__class__.__name__, str(value.dtype), value.shape, value.tobytes())
+    if hasattr(value, '__dict__'):
+        return (value.__class__.__name__, get_content(vars(value)))
+    if isinstance(value, STABLE_TYPES):
+        return value
+    raise UncacheableValue('Values of type {} do not have a stable content'.format(type(value).__name__))
+
+def get_content_hash(values):
+    return hash_content(repr(get_content(values)))
+
+##################################################
+
+class StreamCache(object):
+    """
+    The sequence of outputs of each instance of a stream, keyed by the content hash of its inputs.
+    Each instance is a separate file, so processes that share a directory do not overwrite each other.
+    Files are touched when loaded, and the least recently used are removed when the cache is opened.
+    At most max_entries histories are kept in memory (the least recently used are reloaded from their files).
+    Thread-safe, as stream calls may be made by worker threads (see incremental.STREAM_WORKERS).
+    """
+    def __init__(self, directory, max_entries=MAX_CACHE_ENTRIES, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.history_from_key = OrderedDict() # Least recently used first
+        self.enabled = True
+        self.lock = threading.RLock()
+        self.prune()
+    def get_path(self, key):
+        return os.path.join(self.directory, '{}.pkl'.format(key))
+    def get_history(self, key):
+        with self.lock:
+            return self._get_history(key)
+    def _get_history(self, key):
+        history = self.history_from_key.pop(key, None)
+        if history is None:
+            path = self.get_path(key)
+            history = []
+            if os.path.exists(path):
+                try:
+                    history = read_pickle(path)
+                    os.utime(path, None)
+                except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+                    pass # Corrupted or removed concurrently
+        self.history_from_key[key] = history
+        while self.max_entries < len(self.history_from_key):
+            self.history_from_key.popitem(last=False)
+        return history
+    def disable(self, error):
+        print('Warning! Disabling the cache in {}: {}'.format(self.directory, error))
+        self.enabled = False
+    def append(self, key, output):
+        with self.lock:
+            self._append(key, output)
+    def _append(self, key, output):
+        history = self._get_history(key)
+        history.append(output)
+        if not self.enabled:
+            return
+        path = self.get_path(key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            ensure_dir(path)
+            with open(temp_path, 'wb') as f:
+                pickle.dump(history, f)
+            os.rename(temp_path, path) # Atomic
+        except (pickle.PicklingError, TypeError, AttributeError, IOError, OSError) as error:
+            self.disable(error) # Also a read-only directory or a full disk
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass # Never created
+    def prune(self):
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(reverse=True) # Most recently used first
+        num_bytes = 0
+        for index, (_, size, path) in enumerate(entries):
+            num_bytes += size
+            if (self.max_entries <= index) or (self.max_bytes < num_bytes):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.directory)
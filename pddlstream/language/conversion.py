@@ -2,11 +2,12 @@ from __future__ import print_function
 
 import collections
 from itertools import product
+from operator import itemgetter
 
 from pddlstream.language.constants import EQ, AND, OR, NOT, CONNECTIVES, QUANTIFIERS, OPERATORS, OBJECTIVES, \
     Head, Evaluation, get_prefix, get_args, is_parameter, is_plan, Fact, Not, Equal, Action, StreamAction, \
     DurativeAction, Solution, Assignment
-from pddlstream.language.object import Object, OptimisticObject
+from pddlstream.language.object import Object, OptimisticObject, get_registry
 from pddlstream.utils import str_from_object, apply_mapping
 
 def replace_expression(parent, fn):
@@ -82,6 +83,50 @@ def substitute_expression(parent, mapping):
 def substitute_fact(fact, mapping):
     return Fact(get_prefix(fact), apply_mapping(get_args(fact), mapping))
 
+class SubstitutionTemplate(object):
+    """
+    An expression precompiled against a tuple of parameters, so substitute_expression is a gather by position.
+    Constants are mapped through Object.from_name, and prefixes and other leaves are kept as is.
+    """
+    def __init__(self, expression, parameters, constants=()):
+        self.expression = expression
+        self.num_parameters = len(parameters)
+        self.constants = tuple(constants)
+        self.position_from_leaf = {}
+        for leaf in tuple(parameters) + self.constants:
+            self.position_from_leaf.setdefault(leaf, len(self.position_from_leaf))
+        self.position_from_literal = {}
+        self.literals = []
+        self.getter = self._compile(expression)
+    def _get_position(self, leaf, literal=False):
+        if not literal and (leaf in self.position_from_leaf):
+            return self.position_from_leaf[leaf]
+        if leaf not in self.position_from_literal:
+            self.position_from_literal[leaf] = len(self.position_from_leaf) + len(self.literals)
+            self.literals.append(leaf)
+        return self.position_from_literal[leaf]
+    def _compile(self, expression):
+        children = []
+        for i, child in enumerate(expression):
+            if isinstance(child, (tuple, list)):
+                children.append(self._compile(child))
+            else:
+                children.append(self._get_position(child, literal=(i == 0) and isinstance(child, str)))
+        if not children:
+            return lambda values: ()
+        if all(isinstance(child, int) for child in children):
+            if len(children) == 1:
+                position = children[0]
+                return lambda values: (values[position],)
+            return itemgetter(*children)
+        getters = [itemgetter(child) if isinstance(child, int) else child for child in children]
+        return lambda values: tuple(getter(values) for getter in getters)
+    def instantiate(self, objects):
+        assert len(objects) == self.num_parameters
+        return self.getter(tuple(objects) + tuple(map(Object.from_name, self.constants)) + tuple(self.literals))
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.expression)
+
 ##################################################
 
 def pddl_from_object(obj):
@@ -113,21 +158,44 @@ def objects_from_evaluations(evaluations):
 
 ##################################################
 
-def head_from_fact(fact):
+MAX_INTERNED = 10**6 # Facts interned per table, which is cleared once full (and after each solve)
+
+def get_interned(table, fact, fn):
+    # Each distinct fact is converted once per registry, so repeated conversions reuse the same tuples
+    if table is None:
+        return fn(fact)
+    try:
+        value = table.get(fact)
+    except TypeError: # Unhashable (e.g. a list)
+        return fn(fact)
+    if value is None:
+        if MAX_INTERNED <= len(table):
+            table.clear()
+        value = table[fact] = fn(fact)
+    return value
+
+def _head_from_fact(fact):
     return Head(get_prefix(fact), get_args(fact))
 
-def evaluation_from_fact(fact):
-    prefix = get_prefix(fact)
-    if prefix == EQ:
-        head, value = fact[1:]
-    elif prefix == NOT:
-        head = fact[1]
-        value = False
-    else:
-        head = fact
-        value = True
+def head_from_fact(fact):
+    return get_interned(get_registry().head_from_fact, fact, _head_from_fact)
+
+def _evaluation_from_fact(fact):
+    if get_prefix(fact) == NOT:
+        return Evaluation(head_from_fact(fact[1]), False)
+    return Evaluation(head_from_fact(fact), True)
+
+def _evaluation_from_function_fact(key):
+    fact, _ = key
+    head, value = fact[1:]
     return Evaluation(head_from_fact(head), value)
 
+def evaluation_from_fact(fact):
+    if get_prefix(fact) == EQ:
+        # Keyed by the type of the value as well because values that compare equal (e.g. 1 and True) are distinct
+        return get_interned(get_registry().evaluation_from_fact, (fact, type(fact[2])), _evaluation_from_function_fact)
+    return get_interned(get_registry().evaluation_from_fact, fact, _evaluation_from_fact)
+
 def fact_from_evaluation(evaluation):
     fact = Fact(evaluation.head.function, evaluation.head.args)
     if is_atom(evaluation):
@@ -149,9 +217,9 @@ def fact_from_evaluation(evaluation):
 ##################################################
 
 def obj_from_pddl(pddl):
-    if pddl in Object._obj_from_name:
+    if Object.has_name(pddl):
         return Object.from_name(pddl)
-    elif pddl in OptimisticObject._obj_from_name:
+    elif OptimisticObject.has_name(pddl):
         return OptimisticObject.from_name(pddl)
     raise ValueError(pddl)
 
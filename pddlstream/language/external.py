@@ -1,25 +1,63 @@
+import threading
+import time
+
 from collections import Counter
 
 from pddlstream.algorithms.common import compute_complexity
+from pddlstream.algorithms.context import bind_context
 from pddlstream.language.constants import get_args, is_parameter
-from pddlstream.language.conversion import values_from_objects, substitute_fact
+from pddlstream.language.conversion import values_from_objects, SubstitutionTemplate
 from pddlstream.language.object import Object
 from pddlstream.language.statistics import Performance, PerformanceInfo, DEFAULT_SEARCH_OVERHEAD
-from pddlstream.utils import elapsed_time, get_mapping
+from pddlstream.utils import elapsed_time, get_mapping, INF
 
 DEBUG = 'debug'
+PREEMPT_CALLS = False # Enforces the remaining solver max_time within every call (using a thread per call)
 
 class ExternalInfo(PerformanceInfo):
-    def __init__(self, eager=False, p_success=None, overhead=None, effort=None):
+    def __init__(self, eager=False, p_success=None, overhead=None, effort=None, max_call_time=INF):
         super(ExternalInfo, self).__init__(p_success, overhead, effort)
         # TODO: enable eager=True for inexpensive test streams by default
         # TODO: make any info just a dict
         self.eager = eager
+        self.max_call_time = max_call_time # A call that takes longer counts as a failure (runs calls in a thread)
         #self.complexity_fn = complexity_fn
 
 ##################################################
 
+class CallTimeout(Exception):
+    pass
+
+class Call(object):
+    """
+    A procedure call running in a daemon thread.
+    Python threads cannot be killed, so a call that times out keeps running and can be waited on again.
+    """
+    def __init__(self, fn):
+        self.finished = threading.Event()
+        self.output = None
+        self.error = None
+        thread = threading.Thread(target=self._run, args=(fn,))
+        thread.daemon = True
+        thread.start()
+    def _run(self, fn):
+        try:
+            self.output = fn()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.finished.set()
+    def result(self, max_time=INF):
+        if not self.finished.wait(None if max_time == INF else max(0, max_time)):
+            raise CallTimeout()
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+##################################################
+
 class Result(object):
+    __slots__ = ('instance', 'opt_index', 'call_index', 'optimistic')
     def __init__(self, instance, opt_index, call_index, optimistic):
         self.instance = instance
         self.opt_index = opt_index
@@ -68,22 +106,63 @@ class Result(object):
 
 class Instance(object):
     _Result = None
+    __slots__ = ('external', 'input_objects', '_enumerated', '_disabled', '_opt_index', 'results_history', 'successes',
+                 'opt_results', '_mapping', '_domain', '_prepared', '_prepared_overhead', '_pending_call')
     def __init__(self, external, input_objects):
         self.external = external
         self.input_objects = tuple(input_objects)
-        self.enumerated = False
-        self.disabled = False # TODO: perform disabled using complexity
-        self.opt_index = 0
+        self._enumerated = False
+        self._disabled = False # TODO: perform disabled using complexity
+        self._opt_index = 0
         self.results_history = []
         self.successes = 0
         self.opt_results = []
         self._mapping = None
         self._domain = None
+        self._prepared = None # (output, overhead) of a call made ahead of next_results
+        self._prepared_overhead = 0
+        self._pending_call = None # Call that timed out
 
     @property
     def num_calls(self):
         return len(self.results_history)
 
+    # The optimistic results of an instance only change with num_calls, enumerated, disabled, and opt_index
+    # Changes are logged in external.updated_instances (see OptimisticClosure)
+
+    def _updated(self):
+        self.external.updated_instances.append(self)
+
+    @property
+    def enumerated(self):
+        return self._enumerated
+
+    @enumerated.setter
+    def enumerated(self, enumerated):
+        if enumerated != self._enumerated:
+            self._enumerated = enumerated
+            self._updated()
+
+    @property
+    def disabled(self):
+        return self._disabled
+
+    @disabled.setter
+    def disabled(self, disabled):
+        if disabled != self._disabled:
+            self._disabled = disabled
+            self._updated()
+
+    @property
+    def opt_index(self):
+        return self._opt_index
+
+    @opt_index.setter
+    def opt_index(self, opt_index):
+        if opt_index != self._opt_index:
+            self._opt_index = opt_index
+            self._updated()
+
     @property
     def mapping(self):
         if self._mapping is None:
@@ -98,9 +177,8 @@ class Instance(object):
     @property
     def domain(self):
         if self._domain is None:
-            #self._domain = substitute_expression(self.external.domain, self.get_mapping())
-            self._domain = tuple(substitute_fact(atom, self.get_mapping())
-                                 for atom in self.external.domain)
+            self._domain = self.external.get_template('domain', self.external.inputs).instantiate(
+                self.input_objects)
         return self._domain
 
     def get_domain(self):
@@ -118,7 +196,58 @@ class Instance(object):
     #def has_previous_success(self):
     #    return self.online_success != 0
 
-    def next_results(self, verbose=False):
+    def _call_procedure(self):
+        # Calls the user's procedure without otherwise modifying the instance
+        raise NotImplementedError()
+
+    def _call(self, max_time=INF):
+        # Calls are made on this thread unless the external has a max_call_time (or PREEMPT_CALLS)
+        # Then gives up after the smaller of max_time and max_call_time
+        # The next call resumes (rather than restarts) a call that timed out
+        max_call_time = self.external.info.max_call_time
+        if not PREEMPT_CALLS:
+            max_time = INF if (max_call_time == INF) else max_time
+        max_time = min(max_time, max_call_time)
+        if (self._pending_call is None) and (max_time == INF):
+            return self._call_procedure()
+        call = self._pending_call or Call(bind_context(self._call_procedure))
+        self._pending_call = None
+        try:
+            return call.result(max_time)
+        except CallTimeout:
+            self._pending_call = call
+            raise
+
+    def prepare(self, max_time=INF):
+        # Calls the procedure ahead of next_results (e.g. from a worker thread)
+        # Does not create Objects or update statistics, which next_results does in order
+        start_time = time.time()
+        try:
+            output = self._call(max_time)
+        except CallTimeout as timeout:
+            output = timeout
+        self.prepare_output(output, elapsed_time(start_time))
+
+    def prepare_output(self, output, overhead=0):
+        # Provides the output of a call made elsewhere (e.g. within a batch)
+        assert self._prepared is None
+        self._prepared = (output, overhead)
+
+    def discard_prepared(self):
+        # Drops a prepared output that next_results will not consume
+        self._prepared = None
+
+    def _get_procedure_output(self, max_time=INF):
+        # Raises CallTimeout if the call times out
+        if self._prepared is None:
+            return self._call(max_time)
+        output, self._prepared_overhead = self._prepared
+        self._prepared = None
+        if isinstance(output, CallTimeout):
+            raise output
+        return output
+
+    def next_results(self, verbose=False, max_time=INF):
         raise NotImplementedError()
 
     def get_results(self, start=0):
@@ -141,11 +270,13 @@ class Instance(object):
         return replan_effort + self.external.get_effort(search_overhead=search_overhead)
 
     def update_statistics(self, start_time, results):
-        overhead = elapsed_time(start_time)
+        overhead = elapsed_time(start_time) + self._prepared_overhead
+        self._prepared_overhead = 0
         successes = len([r.is_successful() for r in results])
         self.external.update_statistics(overhead, bool(successes))
         self.results_history.append(results)
         self.successes += successes
+        self._updated()
 
     def disable(self, evaluations, domain):
         self.disabled = True
@@ -174,14 +305,25 @@ class External(Performance):
             print('Warning! Input [{}] for stream [{}] is not covered by a domain condition'.format(p, name))
         self.constants = {a for i in self.domain for a in get_args(i) if not is_parameter(a)}
         self.instances = {}
+        self.updated_instances = [] # Log of the instances whose optimistic results may have changed
+        self.templates = {}
     def is_fluent(self):
         raise NotImplementedError()
     def is_negated(self):
         raise NotImplementedError()
     def is_special(self):
         return False
+    def is_batched(self):
+        return False
     def get_complexity(self, num_calls):
         raise NotImplementedError()
+    def get_template(self, attribute, parameters):
+        # Recompiled if the expression is replaced (e.g. certified facts added by rules)
+        expression = getattr(self, attribute)
+        template = self.templates.get(attribute)
+        if (template is None) or (template.expression is not expression):
+            template = self.templates[attribute] = SubstitutionTemplate(expression, parameters, self.constants)
+        return template
     def get_instance(self, input_objects):
         input_objects = tuple(input_objects)
         assert len(input_objects) == len(self.inputs)
@@ -1,9 +1,11 @@
 import time
 
-from pddlstream.language.conversion import substitute_expression, list_from_conjunction, str_from_head
+from pddlstream.language.conversion import list_from_conjunction, str_from_head
 from pddlstream.language.constants import Not, Equal, get_prefix, get_args, is_head
-from pddlstream.language.external import ExternalInfo, Result, Instance, External, DEBUG, get_procedure_fn
-from pddlstream.utils import str_from_object, apply_mapping
+from pddlstream.language.external import ExternalInfo, Result, Instance, External, DEBUG, get_procedure_fn, \
+    CallTimeout
+from pddlstream.language.generator import resolve
+from pddlstream.utils import str_from_object, apply_mapping, INF
 
 # https://stackoverflow.com/questions/847936/how-can-i-find-the-number-of-arguments-of-a-python-function
 #try:
@@ -22,6 +24,7 @@ class FunctionInfo(ExternalInfo):
         #self.order = 0
 
 class FunctionResult(Result):
+    __slots__ = ('value', '_certified')
     def __init__(self, instance, value, opt_index=None, optimistic=True):
         super(FunctionResult, self).__init__(instance, opt_index, 0, optimistic)
         self.instance = instance
@@ -50,6 +53,7 @@ class FunctionResult(Result):
 
 class FunctionInstance(Instance):
     _Result = FunctionResult
+    __slots__ = ('value', '_head')
     #_opt_value = 0
     def __init__(self, external, input_objects):
         super(FunctionInstance, self).__init__(external, input_objects)
@@ -58,16 +62,21 @@ class FunctionInstance(Instance):
     @property
     def head(self):
         if self._head is None:
-            self._head = substitute_expression(self.external.head, self.get_mapping())
+            self._head = self.external.get_template('head', self.external.inputs).instantiate(self.input_objects)
         return self._head
     def get_head(self):
         return self.head
-    def next_results(self, verbose=False):
+    def _call_procedure(self):
+        return resolve(self.external.fn(*self.get_input_values()))
+    def next_results(self, verbose=False, max_time=INF):
         start_time = time.time()
         assert not self.enumerated
+        try:
+            value = self._get_procedure_output(max_time)
+        except CallTimeout:
+            self.update_statistics(start_time, []) # Counts as a failed call
+            return [], []
         self.enumerated = True
-        input_values = self.get_input_values()
-        value = self.external.fn(*input_values)
         self.value = self.external.codomain(value)
         # TODO: cast the inputs and test whether still equal?
         #if not (type(self.value) is self.external._codomain):
@@ -130,6 +139,7 @@ class Function(External):
 ##################################################
 
 class PredicateResult(FunctionResult):
+    __slots__ = ()
     def get_certified(self):
         # TODO: cache these results
         expression = self.instance.get_head()
@@ -140,6 +150,7 @@ class PredicateResult(FunctionResult):
 
 class PredicateInstance(FunctionInstance):
     _Result = PredicateResult
+    __slots__ = ()
     #_opt_value = True # True | False | Predicate._codomain()
     #def was_successful(self, results):
     #    #self.external.opt_fn(*input_values)
@@ -1,9 +1,21 @@
+import inspect
+import threading
 import time
 from collections import Iterator, namedtuple, deque
 from itertools import count
 
 from pddlstream.utils import INF, elapsed_time
 
+try:
+    import asyncio
+except ImportError: # Python 2
+    asyncio = None
+
+try:
+    from concurrent.futures import Future
+except ImportError: # Python 2 without the futures backport
+    Future = None
+
 # TODO: indicate wild stream output just from the output form
 # TODO: depth limited and cycle-free optimistic objects
 
@@ -43,16 +55,77 @@ def get_next(generator, default=[]):
 
 ##################################################
 
+# Procedures may be async def functions or async generators, or may return concurrent futures
+# Coroutines from all solver threads run on a single event loop in a daemon thread, so a stream call only
+# blocks its own (worker) thread; with incremental.STREAM_WORKERS > 1, many calls are in flight at once
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def get_event_loop():
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_event_loop.run_forever, name='pddlstream-event-loop')
+            thread.daemon = True
+            thread.start()
+    return _event_loop
+
+
+def is_awaitable(value):
+    return (asyncio is not None) and inspect.isawaitable(value)
+
+
+def is_async_generator(value):
+    return hasattr(inspect, 'isasyncgen') and inspect.isasyncgen(value)
+
+
+def resolve(value):
+    # Waits for the result of a concurrent future or an awaitable (e.g. a coroutine)
+    # Blocks the calling thread, so calls only overlap when several threads make them (STREAM_WORKERS > 1)
+    if (Future is not None) and isinstance(value, Future):
+        return value.result()
+    if is_awaitable(value):
+        # wait_for (without a timeout) wraps awaitables that are not coroutines
+        return asyncio.run_coroutine_threadsafe(asyncio.wait_for(value, None), get_event_loop()).result()
+    return value
+
+
+def iterate_async(async_generator):
+    while True:
+        try:
+            yield resolve(async_generator.__anext__())
+        except StopAsyncIteration:
+            return
+
+
+def iterate(generator):
+    # Iterates over a generator or an async generator, waiting for elements that are futures or awaitables
+    # A coroutine (e.g. from a plain async def) or future is awaited first and its result is iterated
+    if is_awaitable(generator) or ((Future is not None) and isinstance(generator, Future)):
+        generator = resolve(generator)
+    if is_async_generator(generator):
+        generator = iterate_async(generator)
+    for value in generator:
+        yield resolve(value)
+
+##################################################
+
 # Methods that convert some procedure -> function to a generator of lists
 
 def from_list_gen_fn(list_gen_fn):
-    # Purposefully redundant for now
-    return list_gen_fn
+    def gen_fn(*args, **kwargs):
+        generator = list_gen_fn(*args, **kwargs)
+        if isinstance(generator, BoundedGenerator):
+            return generator # Still reports when it is enumerated (see get_next)
+        return iterate(generator)
+    return gen_fn
 
 
 def from_gen_fn(gen_fn):
     return from_list_gen_fn(lambda *args, **kwargs: ([] if ov is None else [ov]
-                                                     for ov in gen_fn(*args, **kwargs)))
+                                                     for ov in iterate(gen_fn(*args, **kwargs))))
 
 
 def from_sampler(sampler, max_attempts=INF):
@@ -68,12 +141,12 @@ def from_sampler(sampler, max_attempts=INF):
 
 def from_list_fn(list_fn):
     #return lambda *args, **kwargs: iter([list_fn(*args, **kwargs)])
-    return lambda *args, **kwargs: BoundedGenerator(iter([list_fn(*args, **kwargs)]), max_calls=1)
+    return lambda *args, **kwargs: BoundedGenerator(iter([resolve(list_fn(*args, **kwargs))]), max_calls=1)
 
 
 def from_fn(fn):
     def list_fn(*args, **kwargs):
-        outputs = fn(*args, **kwargs)
+        outputs = resolve(fn(*args, **kwargs))
         return [] if outputs is None else [outputs]
     return from_list_fn(list_fn)
 
@@ -82,7 +155,7 @@ def outputs_from_boolean(boolean):
 
 
 def from_test(test):
-    return from_fn(lambda *args, **kwargs: outputs_from_boolean(test(*args, **kwargs)))
+    return from_fn(lambda *args, **kwargs: outputs_from_boolean(resolve(test(*args, **kwargs))))
 
 
 def from_constant(constant):
@@ -98,6 +171,30 @@ def empty_gen():
 
 ##################################################
 
+# Methods that convert a batch procedure -> function to a BoundedGenerator
+# A batch procedure receives one list of values per input (one entry per instance) and returns a sequence with
+# one output (or boolean) per instance, so it can be vectorized (e.g. using numpy arrays)
+# Ready instances of the stream are called together, up to StreamInfo.batch_size at once
+
+def from_batch_fn(batch_fn):
+    def fn(*args, **kwargs):
+        [outputs] = resolve(batch_fn(*[[arg] for arg in args], **kwargs))
+        return outputs
+    gen_fn = from_fn(fn)
+    gen_fn.batch_fn = batch_fn
+    return gen_fn
+
+
+def from_batch_test(batch_test):
+    return from_batch_fn(lambda *args, **kwargs: [outputs_from_boolean(boolean)
+                                                  for boolean in resolve(batch_test(*args, **kwargs))])
+
+
+def get_batch_fn(gen_fn):
+    return getattr(gen_fn, 'batch_fn', None)
+
+##################################################
+
 # Methods that convert some procedure -> function
 
 def fn_from_constant(constant):
@@ -1,54 +1,190 @@
+import threading
+import weakref
+
 from collections import namedtuple
 from itertools import count
 from pddlstream.language.constants import get_parameter_name
 from pddlstream.utils import str_from_object, is_hashable
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 USE_HASH = True
 USE_OBJ_STR = True
 USE_OPT_STR = True
 OPT_PREFIX = '#'
 
+##################################################
+
+# Canonical keys for unhashable values, so that equal values (e.g. duplicate numpy samples) share an Object
+# Unhashable values without a key are identified by their id
+
+key_fn_from_type = {}
+
+def register_canonical(cls, key_fn):
+    # key_fn maps a value of type cls (or a subclass) to a hashable key (or None to fall back on its id)
+    key_fn_from_type[cls] = key_fn
+
+def get_canonical_key(value):
+    for cls in type(value).__mro__:
+        if cls in key_fn_from_type:
+            key = key_fn_from_type[cls](value)
+            return None if key is None else (cls, key)
+    return None
+
+def get_array_key_fn(tolerance=None):
+    # Values are quantized to multiples of tolerance (nearby values in different cells remain distinct)
+    # The key includes the original dtype and shape, so arrays that only differ in them are not merged
+    def key_fn(array):
+        dtype, shape = array.dtype.str, array.shape
+        if tolerance is not None:
+            array = np.round(np.asarray(array, dtype=float) / tolerance).astype(np.int64)
+        elif array.dtype.kind == 'f':
+            array = array + 0. # Normalizes -0.
+        elif array.dtype.kind == 'O':
+            return None
+        return (dtype, shape, np.ascontiguousarray(array).tobytes())
+    return key_fn
+
+if np is not None:
+    register_canonical(np.ndarray, get_array_key_fn())
+
+##################################################
+
+class ObjectRegistry(object):
+    """
+    The lookup tables for Object and OptimisticObject.
+    Each solver context owns one so concurrent solves never alias each other's objects.
+    A weak registry does not keep objects (or their values) alive, so objects that are no longer
+    referenced (e.g. by evaluations or stream instances) are freed during a long-running session.
+    """
+    _local = threading.local()
+    def __init__(self, weak=False):
+        self.weak = weak
+        table = weakref.WeakValueDictionary if weak else dict
+        self.obj_from_id = table()
+        self.obj_from_value = table()
+        self.obj_from_key = table() # Unhashable values with a canonical key
+        self.obj_from_name = table()
+        self.opt_from_inputs = table()
+        self.opt_from_name = table()
+        self.count_from_prefix = {}
+        self.constants = [] # Named objects are looked up by name later, so they are never released when weak
+        self.num_objects = 0 # Tables may shrink when weak, so objects are numbered by counters
+        self.num_optimistic = 0
+        # Interned facts (see conversion.evaluation_from_fact), which would keep objects alive when weak
+        self.head_from_fact = None if weak else {}
+        self.evaluation_from_fact = None if weak else {}
+    def reset_facts(self):
+        if not self.weak:
+            self.head_from_fact.clear()
+            self.evaluation_from_fact.clear()
+    def reset_objects(self):
+        self.obj_from_id.clear()
+        self.obj_from_value.clear()
+        self.obj_from_key.clear()
+        self.obj_from_name.clear()
+        self.constants[:] = []
+        self.num_objects = 0
+        self.reset_facts()
+    def reset_optimistic(self):
+        self.opt_from_inputs.clear()
+        self.opt_from_name.clear()
+        self.count_from_prefix.clear()
+        self.num_optimistic = 0
+        self.reset_facts()
+    def reset(self):
+        # Releases every object created within this registry
+        self.reset_objects()
+        self.reset_optimistic()
+    release = reset
+    @staticmethod
+    def get_active():
+        stack = getattr(ObjectRegistry._local, 'stack', None)
+        return stack[-1] if stack else DEFAULT_REGISTRY
+    def __enter__(self):
+        if not hasattr(ObjectRegistry._local, 'stack'):
+            ObjectRegistry._local.stack = []
+        ObjectRegistry._local.stack.append(self)
+        return self
+    def __exit__(self, *args):
+        assert ObjectRegistry._local.stack.pop() is self
+    def __repr__(self):
+        return '{}(objects={}, optimistic={})'.format(
+            self.__class__.__name__, len(self.obj_from_name), len(self.opt_from_name))
+
+DEFAULT_REGISTRY = ObjectRegistry()
+
+def get_registry():
+    return ObjectRegistry.get_active()
+
+##################################################
+
 class Object(object):
     _prefix = 'v'
-    _obj_from_id = {}
-    _obj_from_value = {}
-    _obj_from_name = {}
+    __slots__ = ('value', 'index', 'pddl', 'stream_instance', '__weakref__') # Weak registries reference objects
     def __init__(self, value, stream_instance=None, name=None):
+        registry = get_registry()
         self.value = value
-        self.index = len(Object._obj_from_name)
+        self.index = registry.num_objects
+        registry.num_objects += 1
         if name is None:
             name = '{}{}'.format(self._prefix, self.index)
+        else:
+            registry.constants.append(self)
         self.pddl = name
         self.stream_instance = stream_instance # TODO: store first created stream instance
-        Object._obj_from_id[id(self.value)] = self
-        Object._obj_from_name[self.pddl] = self
+        registry.obj_from_name[self.pddl] = self
         if is_hashable(value):
-            Object._obj_from_value[self.value] = self
+            registry.obj_from_id[id(self.value)] = self
+            registry.obj_from_value[self.value] = self
+        else:
+            key = get_canonical_key(value)
+            if key is None:
+                registry.obj_from_id[id(self.value)] = self
+            else:
+                # Not indexed by id, which would keep value alive (and a recycled id would alias it)
+                registry.obj_from_key.setdefault(key, self)
     @staticmethod
     def from_id(value):
-        if id(value) not in Object._obj_from_id:
+        obj_from_id = get_registry().obj_from_id
+        if id(value) not in obj_from_id:
             return Object(value)
-        return Object._obj_from_id[id(value)]
+        return obj_from_id[id(value)]
     @staticmethod
     def has_value(value):
+        registry = get_registry()
         if USE_HASH and not is_hashable(value):
-            return id(value) in Object._obj_from_id
-        return value in Object._obj_from_value
+            key = get_canonical_key(value)
+            if key is None:
+                return id(value) in registry.obj_from_id
+            return key in registry.obj_from_key
+        return value in registry.obj_from_value
     @staticmethod
     def from_value(value):
         if USE_HASH and not is_hashable(value):
-            return Object.from_id(value)
-        if value not in Object._obj_from_value:
+            key = get_canonical_key(value)
+            if key is None:
+                return Object.from_id(value)
+            obj_from_key = get_registry().obj_from_key
+            if key not in obj_from_key:
+                return Object(value)
+            return obj_from_key[key]
+        obj_from_value = get_registry().obj_from_value
+        if value not in obj_from_value:
             return Object(value)
-        return Object._obj_from_value[value]
+        return obj_from_value[value]
+    @staticmethod
+    def has_name(name):
+        return name in get_registry().obj_from_name
     @staticmethod
     def from_name(name):
-        return Object._obj_from_name[name]
+        return get_registry().obj_from_name[name]
     @staticmethod
     def reset():
-        Object._obj_from_id.clear()
-        Object._obj_from_value.clear()
-        Object._obj_from_name.clear()
+        get_registry().reset_objects()
     def __lt__(self, other): # For heapq on python3
         return self.index < other.index
     def __repr__(self):
@@ -63,39 +199,41 @@ UniqueOptValue = namedtuple('UniqueOpt', ['instance', 'sequence_index', 'output_
 
 class OptimisticObject(object):
     _prefix = '{}o'.format(OPT_PREFIX) # $ % #
-    _obj_from_inputs = {}
-    _obj_from_name = {}
-    _count_from_prefix = {}
+    __slots__ = ('value', 'param', 'index', 'pddl', 'repr_name', '__weakref__')
     def __init__(self, value, param):
         # TODO: store first created instance
+        registry = get_registry()
         self.value = value
         self.param = param
-        self.index = len(OptimisticObject._obj_from_inputs)
+        self.index = registry.num_optimistic
+        registry.num_optimistic += 1
         self.pddl = '{}{}'.format(self._prefix, self.index)
-        OptimisticObject._obj_from_inputs[(value, param)] = self
-        OptimisticObject._obj_from_name[self.pddl] = self
+        registry.opt_from_inputs[(value, param)] = self
+        registry.opt_from_name[self.pddl] = self
         self.repr_name = self.pddl
         if USE_OPT_STR and isinstance(self.param, UniqueOptValue):
             # TODO: instead just endow UniqueOptValue with a string function
             parameter = self.param.instance.external.outputs[self.param.output_index]
             prefix = get_parameter_name(parameter)[:1]
-            var_index = next(self._count_from_prefix.setdefault(prefix, count()))
+            var_index = next(registry.count_from_prefix.setdefault(prefix, count()))
             self.repr_name = '{}{}{}'.format(OPT_PREFIX, prefix, var_index) #self.index)
     @staticmethod
     def from_opt(value, param):
         # TODO: make param have a default value?
         key = (value, param)
-        if key not in OptimisticObject._obj_from_inputs:
+        opt_from_inputs = get_registry().opt_from_inputs
+        if key not in opt_from_inputs:
             return OptimisticObject(value, param)
-        return OptimisticObject._obj_from_inputs[key]
+        return opt_from_inputs[key]
+    @staticmethod
+    def has_name(name):
+        return name in get_registry().opt_from_name
     @staticmethod
     def from_name(name):
-        return OptimisticObject._obj_from_name[name]
+        return get_registry().opt_from_name[name]
     @staticmethod
     def reset():
-        OptimisticObject._obj_from_inputs.clear()
-        OptimisticObject._obj_from_name.clear()
-        OptimisticObject._count_from_prefix.clear()
+        get_registry().reset_optimistic()
     def __lt__(self, other): # For heapq on python3
         return self.index < other.index
     def __repr__(self):
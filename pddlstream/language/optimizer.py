@@ -3,12 +3,11 @@ from collections import defaultdict
 from pddlstream.algorithms.scheduling.utils import partition_external_plan
 from pddlstream.language.constants import get_prefix, get_args, get_parameter_name, is_parameter, Minimize
 from pddlstream.language.conversion import substitute_expression, list_from_conjunction
-from pddlstream.language.external import parse_lisp_list, get_procedure_fn
+from pddlstream.language.external import parse_lisp_list, get_procedure_fn, CallTimeout
 from pddlstream.language.function import PredicateResult, FunctionResult
 from pddlstream.language.object import Object
 from pddlstream.language.stream import OptValue, StreamInfo, Stream, StreamInstance, StreamResult, \
     PartialInputs, NEGATIVE_SUFFIX, WildOutput
-from pddlstream.language.generator import get_next
 from pddlstream.utils import INF, get_mapping, safe_zip, str_from_object
 from pddlstream.algorithms.reorder import get_stream_plan_components, get_partial_orders
 
@@ -182,9 +181,11 @@ class OptimizerInstance(StreamInstance):
         # TODO: cluster connected components in the infeasible set
         # TODO: compute things dependent on a stream and treat like an optimizer
         # Also make an option to just treat everything like an optimizer
-    def _next_outputs(self):
-        self._create_generator()
-        output, self.enumerated = get_next(self._generator, default=[])
+    def _next_outputs(self, max_time=INF):
+        try:
+            output, self.enumerated = self._get_procedure_output(max_time)
+        except CallTimeout:
+            output = [] # Counts as a failed call
         if not isinstance(output, OptimizerOutput):
             output = OptimizerOutput(assignments=output)
         self.infeasible.update(output.infeasible)
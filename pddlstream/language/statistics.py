@@ -1,16 +1,17 @@
 from __future__ import print_function
 
 import os
+import tempfile
 
 from collections import Counter
 
 from pddlstream.language.constants import is_plan
+from pddlstream.algorithms.context import get_context, DATA_DIR
 from pddlstream.utils import INF, read_pickle, ensure_dir, write_pickle, get_python_version
 
 LOAD_STATISTICS = True
 SAVE_STATISTICS = True
 
-DATA_DIR = 'statistics/py{:d}/'
 DEFAULT_SEARCH_OVERHEAD = 10 # TODO: update this over time
 # Can also include the overhead to process skeletons
 
@@ -41,27 +42,29 @@ def compute_plan_effort(stream_plan, **kwargs):
 
 # TODO: write to a "local" folder containing temp, data2, data3, visualizations
 
-def get_data_path(stream_name):
-    data_dir = DATA_DIR.format(get_python_version())
+def get_data_path(stream_name, data_dir=None):
+    if data_dir is None:
+        data_dir = get_context().data_dir
+    data_dir = data_dir.format(get_python_version())
     file_name = '{}.pkl'.format(stream_name)
     return os.path.join(data_dir, file_name)
 
-def load_data(pddl_name):
+def load_data(pddl_name, data_dir=None):
     if not LOAD_STATISTICS:
         return {}
-    filename = get_data_path(pddl_name)
+    filename = get_data_path(pddl_name, data_dir)
     if not os.path.exists(filename):
         return {}
     data = read_pickle(filename)
     #print('Loaded:', filename)
     return data
 
-def load_stream_statistics(externals):
+def load_stream_statistics(externals, data_dir=None):
     if not externals:
         return
     pddl_name = externals[0].pddl_name # TODO: ensure the same
     # TODO: fresh restart flag
-    data = load_data(pddl_name)
+    data = load_data(pddl_name, data_dir)
     for external in externals:
         if external.name in data:
             external.load_statistics(data[external.name])
@@ -117,7 +120,15 @@ def merge_data(external, previous_data):
     }
     # TODO: make an instance method
 
-def write_stream_statistics(externals, verbose):
+def write_pickle_atomic(filename, data):
+    # Concurrent solvers may share a statistics directory, so readers must never see a partial file
+    ensure_dir(filename)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename) or None, suffix='.tmp')
+    os.close(fd)
+    write_pickle(temp_path, data)
+    getattr(os, 'replace', os.rename)(temp_path, filename) # os.replace is python3 only
+
+def write_stream_statistics(externals, verbose, data_dir=None):
     # TODO: estimate conditional to affecting history on skeleton
     # TODO: estimate conditional to first & attempt and success
     # TODO: relate to success for the full future plan
@@ -128,7 +139,7 @@ def write_stream_statistics(externals, verbose):
         #dump_online_statistics(externals)
         dump_total_statistics(externals)
     pddl_name = externals[0].pddl_name # TODO: ensure the same
-    previous_data = load_data(pddl_name)
+    previous_data = load_data(pddl_name, data_dir)
     data = {}
     for external in externals:
         if not hasattr(external, 'instances'):
@@ -139,9 +150,8 @@ def write_stream_statistics(externals, verbose):
 
     if not SAVE_STATISTICS:
         return
-    filename = get_data_path(pddl_name)
-    ensure_dir(filename)
-    write_pickle(filename, data)
+    filename = get_data_path(pddl_name, data_dir)
+    write_pickle_atomic(filename, data)
     if verbose:
         print('Wrote:', filename)
 
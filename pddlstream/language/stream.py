@@ -1,17 +1,23 @@
+import os
 import time
+import threading
 from collections import Counter, defaultdict, namedtuple, Sequence
 from itertools import count
 
 from pddlstream.algorithms.common import INTERNAL_EVALUATION, add_fact
+from pddlstream.algorithms.context import get_context
 from pddlstream.algorithms.downward import make_axiom
 from pddlstream.language.constants import AND, get_prefix, get_args, is_parameter, Fact, concatenate, StreamAction
-from pddlstream.language.conversion import list_from_conjunction, substitute_expression, \
+from pddlstream.language.cache import StreamCache, UncacheableValue, get_content_hash
+from pddlstream.language.conversion import list_from_conjunction, \
     get_formula_operators, values_from_objects, obj_from_value_expression, evaluation_from_fact
 from pddlstream.language.external import ExternalInfo, Result, Instance, External, DEBUG, get_procedure_fn, \
-    parse_lisp_list
-from pddlstream.language.generator import get_next, from_fn
+    parse_lisp_list, CallTimeout
+from pddlstream.language.generator import get_next, from_fn, is_async_generator, iterate, resolve, \
+    get_batch_fn
 from pddlstream.language.object import Object, OptimisticObject, UniqueOptValue
-from pddlstream.utils import str_from_object, get_mapping, irange, apply_mapping, INF
+from pddlstream.utils import str_from_object, get_mapping, irange, apply_mapping, elapsed_time, \
+    get_python_version, INF
 
 VERBOSE_FAILURES = True
 VERBOSE_WILD = False
@@ -108,18 +114,22 @@ class DebugValue(object): # TODO: could just do an object
 ##################################################
 
 class StreamInfo(ExternalInfo):
-    def __init__(self, opt_gen_fn=PartialInputs(), negate=False, simultaneous=False, defer=False, **kwargs):
+    def __init__(self, opt_gen_fn=PartialInputs(), negate=False, simultaneous=False, defer=False,
+                 batch_size=INF, cache=False, **kwargs):
         # TODO: could change frequency/priority for the incremental algorithm
         super(StreamInfo, self).__init__(**kwargs)
         self.opt_gen_fn = opt_gen_fn # TODO: call this an abstraction instead
         self.negate = negate
         self.simultaneous = simultaneous
         self.defer = defer
+        self.batch_size = batch_size # Maximum number of instances per call of a batch procedure (see from_batch_fn)
+        self.cache = cache # Records outputs on disk and replays them in later runs (see StreamCache)
         #self.order = 0
 
 ##################################################
 
 class StreamResult(Result):
+    __slots__ = ('output_objects', 'list_index', '_mapping', '_certified', '_stream_fact')
     def __init__(self, instance, output_objects, opt_index=None,
                  call_index=None, list_index=None, optimistic=True):
         super(StreamResult, self).__init__(instance, opt_index, call_index, optimistic)
@@ -143,12 +153,14 @@ class StreamResult(Result):
     @property
     def stream_fact(self):
         if self._stream_fact is None:
-            self._stream_fact = substitute_expression(self.external.stream_fact, self.mapping)
+            self._stream_fact = self.external.get_template('stream_fact', self.external.parameters).instantiate(
+                self.input_objects + self.output_objects)
         return self._stream_fact
     @property
     def certified(self):
         if self._certified is None:
-            self._certified = substitute_expression(self.external.certified, self.get_mapping())
+            self._certified = self.external.get_template('certified', self.external.parameters).instantiate(
+                self.input_objects + self.output_objects)
         return self._certified
     def get_certified(self):
         return self.certified
@@ -174,10 +186,12 @@ class StreamResult(Result):
 
 class StreamInstance(Instance):
     _Result = StreamResult
+    __slots__ = ('_generator', 'fluent_facts', 'opt_gen_fn', 'num_optimistic', 'previous_outputs',
+                 '_axiom_predicate', '_disabled_axiom', '_cache_key', '_cache_index')
     def __init__(self, stream, input_objects, fluent_facts):
         super(StreamInstance, self).__init__(stream, input_objects)
         self._generator = None
-        self.opt_index = stream.num_opt_fns
+        self._opt_index = stream.num_opt_fns # Not logged as an update
         self.fluent_facts = frozenset(fluent_facts)
         opt_gen_fn = self.external.info.opt_gen_fn
         self.opt_gen_fn = opt_gen_fn.get_opt_gen_fn(self) \
@@ -186,6 +200,8 @@ class StreamInstance(Instance):
         self.previous_outputs = set()
         self._axiom_predicate = None
         self._disabled_axiom = None
+        self._cache_key = None
+        self._cache_index = 0 # Number of calls made through the StreamCache
         # TODO: keep track of unique outputs to prune repeated ones
 
     def _check_output_values(self, new_values):
@@ -228,19 +244,54 @@ class StreamInstance(Instance):
             self._generator = self.external.gen_fn(*input_values, fluents=self.get_fluent_values())
         else:
             self._generator = self.external.gen_fn(*input_values)
+        if is_async_generator(self._generator):
+            self._generator = iterate(self._generator)
+
+    def get_cache_key(self):
+        # False if the instance is not cached
+        if self._cache_key is None:
+            try:
+                self._cache_key = get_content_hash((self.get_input_values(), self.get_fluent_values()))
+            except UncacheableValue as error:
+                print('Warning! Not caching {}: {}'.format(self, error))
+                self._cache_key = False
+        return self._cache_key
+
+    def _call_procedure(self):
+        cache = self.external.get_cache()
+        if (cache is None) or (self.get_cache_key() is False):
+            self._create_generator()
+            return get_next(self._generator, default=[])
+        history = cache.get_history(self._cache_key)
+        self._cache_index += 1
+        if (self._generator is None) and (self._cache_index <= len(history)):
+            return history[self._cache_index - 1] # Replays a recorded call
+        if self._generator is None:
+            # The generator starts from scratch, so its outputs for the replayed calls are skipped
+            self._create_generator()
+            for _ in range(self._cache_index - 1):
+                _, enumerated = get_next(self._generator, default=[])
+                if enumerated:
+                    return [], True
+        output = get_next(self._generator, default=[])
+        if len(history) < self._cache_index:
+            cache.append(self._cache_key, output) # Only calls beyond the recorded ones are recorded
+        return output
 
-    def _next_outputs(self):
-        self._create_generator()
-        output, self.enumerated = get_next(self._generator, default=[])
+    def _next_outputs(self, max_time=INF):
+        try:
+            output, self.enumerated = self._get_procedure_output(max_time)
+        except CallTimeout:
+            output = [] # Counts as a failed call
         if not isinstance(output, WildOutput):
             output = WildOutput(output, [])
         return output
 
-    def next_results(self, verbose=False):
+    def next_results(self, verbose=False, max_time=INF):
         assert not self.enumerated
         start_time = time.time()
         start_calls = self.num_calls
-        new_values, new_facts = self._next_outputs()
+        new_values, new_facts = self._next_outputs(max_time)
         self._check_output_values(new_values)
         self._check_wild_facts(new_facts)
         new_objects = [tuple(map(Object.from_value, output_values)) for output_values in new_values]
@@ -341,6 +392,21 @@ class StreamInstance(Instance):
     def __repr__(self):
         return '{}:{}->{}'.format(self.external.name, self.input_objects, self.external.outputs)
 
+def prepare_batch(instances):
+    # Calls the batch procedure of a stream once for several of its instances (see from_batch_fn)
+    stream = instances[0].external
+    assert stream.is_batched() and all(instance.external is stream for instance in instances)
+    start_time = time.time()
+    input_lists = [list(values) for values in zip(*[instance.get_input_values() for instance in instances])]
+    outputs_list = list(resolve(stream.batch_fn(*input_lists)))
+    if len(outputs_list) != len(instances):
+        raise ValueError('Batch procedure for stream [{}] returned {} outputs for {} inputs'.format(
+            stream.name, len(outputs_list), len(instances)))
+    overhead = elapsed_time(start_time) / len(instances)
+    for instance, outputs in zip(instances, outputs_list):
+        # Same output as get_next on the from_fn generator
+        instance.prepare_output(([] if outputs is None else [outputs], True), overhead)
+
 ##################################################
 
 class Stream(External):
@@ -367,6 +433,9 @@ class Stream(External):
         # TODO: automatically switch to unique if only used once
         self.gen_fn = get_debug_gen_fn(self) if gen_fn == DEBUG else gen_fn
         assert callable(self.gen_fn)
+        self.batch_fn = get_batch_fn(self.gen_fn)
+        self._cache = None
+        self._cache_lock = threading.Lock() # Stream calls may be made by worker threads
         self.num_opt_fns = 1 if self.outputs else 0 # Always unique if no outputs
         if isinstance(self.info.opt_gen_fn, PartialInputs) and self.info.opt_gen_fn.unique:
             self.num_opt_fns = 0
@@ -395,6 +464,9 @@ class Stream(External):
     def is_negated(self):
         return self.info.negate
 
+    @property
+    def parameters(self):
+        return self.inputs + self.outputs
     def get_complexity(self, num_calls):
         #if self.is_negated():
         #    return INF
@@ -403,6 +475,19 @@ class Stream(External):
     def is_special(self):
         return self.is_fluent() or self.is_negated()
 
+    def is_batched(self):
+        return (self.batch_fn is not None) and (1 < self.info.batch_size) and not self.is_fluent()
+
+    def get_cache(self):
+        if not self.info.cache or (self.gen_fn == DEBUG):
+            return None
+        with self._cache_lock:
+            if self._cache is None:
+                cache_dir = get_context().cache_dir.format(get_python_version())
+                pddl_name = getattr(self, 'pddl_name', None)
+                self._cache = StreamCache(os.path.join(cache_dir, '{}-{}'.format(pddl_name, self.name)))
+        return self._cache
+
     def get_instance(self, input_objects, fluent_facts=frozenset()):
         assert all(isinstance(obj, Object) or isinstance(obj, OptimisticObject) for obj in input_objects)
         key = (tuple(input_objects), frozenset(fluent_facts))
@@ -8,11 +8,13 @@ import time
 import sys
 
 from collections import namedtuple
+from copy import deepcopy
 
-from pddlstream.algorithms.downward import TEMP_DIR, DOMAIN_INPUT, PROBLEM_INPUT, make_effects, \
-    parse_sequential_domain, get_conjunctive_parts
+from pddlstream.algorithms.downward import get_temp_dir, DOMAIN_INPUT, PROBLEM_INPUT, make_effects, \
+    parse_sequential_domain, get_conjunctive_parts, get_cost_scale, CACHE_PDDL, MAX_CACHED_PDDL
 from pddlstream.language.constants import DurativeAction
-from pddlstream.utils import INF, ensure_dir, write, user_input, safe_rm_dir, read, elapsed_time, find_unique, safe_zip
+from pddlstream.utils import INF, ensure_dir, write, user_input, safe_rm_dir, read, elapsed_time, find_unique, safe_zip, \
+    LRUCache, hash_content
 
 PLANNER = 'tfd' # tfd | tflap | optic | tpshe | cerberus
 
@@ -311,12 +313,13 @@ def parse_temporal_solution(solution):
         makespan = max(action.start + action.duration, makespan)
     return plan, makespan
 
-def write_pddl(domain_pddl, problem_pddl):
+def write_pddl(domain_pddl, problem_pddl, temp_dir=None):
     # TODO: already in downward.py
-    safe_rm_dir(TEMP_DIR)  # Ensures not using old plan
-    ensure_dir(TEMP_DIR)
-    domain_path = TEMP_DIR + DOMAIN_INPUT
-    problem_path = TEMP_DIR + PROBLEM_INPUT
+    temp_dir = get_temp_dir(temp_dir)
+    safe_rm_dir(temp_dir)  # Ensures not using old plan
+    ensure_dir(temp_dir)
+    domain_path = os.path.join(temp_dir, DOMAIN_INPUT)
+    problem_path = os.path.join(temp_dir, PROBLEM_INPUT)
     write(domain_path, domain_pddl)
     write(problem_path, problem_pddl)
     return domain_path, problem_path
@@ -389,7 +392,7 @@ def parse_temporal_domain(domain_pddl):
                           {p.name: p for p in predicates}, functions, simple_actions, axioms,
                           simple_from_durative, domain_pddl)
 
-def parse_domain(domain_pddl):
+def parse_uncached_domain(domain_pddl):
     try:
         return parse_sequential_domain(domain_pddl)
     except AssertionError as e:
@@ -397,6 +400,17 @@ def parse_domain(domain_pddl):
             return parse_temporal_domain(domain_pddl)
         raise e
 
+DOMAIN_CACHE = LRUCache(max_size=MAX_CACHED_PDDL)
+
+def parse_domain(domain_pddl):
+    if not CACHE_PDDL or not isinstance(domain_pddl, str):
+        return parse_uncached_domain(domain_pddl)
+    key = (hash_content(domain_pddl), get_cost_scale())
+    domain = DOMAIN_CACHE.get(key)
+    if domain is None:
+        domain = DOMAIN_CACHE[key] = parse_uncached_domain(domain_pddl)
+    return deepcopy(domain) # parse_problem modifies the domain in place
+
 ##################################################
 
 def delete_imports(prefixes=['pddl']):
@@ -511,7 +525,7 @@ def sequential_from_temporal_plan(plan):
 
 ##################################################
 
-def solve_tfd(domain_pddl, problem_pddl, max_time=INF, debug=False):
+def solve_tfd(domain_pddl, problem_pddl, max_time=INF, temp_dir=None, debug=False):
     if PLANNER == 'tfd':
         root, template = TFD_PATH, TFD_COMMAND
     elif PLANNER == 'cerberus':
@@ -526,11 +540,12 @@ def solve_tfd(domain_pddl, problem_pddl, max_time=INF, debug=False):
         raise ValueError(PLANNER)
 
     start_time = time.time()
-    domain_path, problem_path = write_pddl(domain_pddl, problem_pddl)
-    plan_path = os.path.join(TEMP_DIR, PLAN_FILE)
+    temp_path = os.path.join(os.path.abspath(get_temp_dir(temp_dir)), '') # The planner is run from its own directory
+    domain_path, problem_path = write_pddl(domain_pddl, problem_pddl, temp_path)
+    plan_path = os.path.join(temp_path, PLAN_FILE)
     #assert not actions, "There shouldn't be any actions - just temporal actions"
 
-    paths = [os.path.join(os.getcwd(), p) for p in (domain_path, problem_path, plan_path)]
+    paths = [domain_path, problem_path, plan_path]
     command = os.path.join(root, template.format(*paths))
     print(command)
     if debug:
@@ -542,12 +557,11 @@ def solve_tfd(domain_pddl, problem_pddl, max_time=INF, debug=False):
     print('Error:', error)
     # TODO: close any opened resources
 
-    temp_path = os.path.join(os.getcwd(), TEMP_DIR)
     plan_files = sorted(f for f in os.listdir(temp_path) if f.startswith(PLAN_FILE))
     print('Plans:', plan_files)
     best_plan, best_makespan = parse_plans(temp_path, plan_files)
     #if not debug:
-    #    safe_rm_dir(TEMP_DIR)
+    #    safe_rm_dir(temp_path)
     print('Makespan: ', best_makespan)
     print('Time:', elapsed_time(start_time))
 
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import hashlib
 import math
 import os
 import pickle
@@ -7,8 +8,9 @@ import shutil
 import sys
 import time
 import random
+import threading
 
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from heapq import heappush, heappop
 
 import numpy as np
@@ -64,7 +66,11 @@ def mkdir(d):
 def ensure_dir(f):
     d = os.path.dirname(f)
     if not os.path.exists(d):
-        os.makedirs(d)
+        try:
+            os.makedirs(d)
+        except OSError: # Another process may have created it concurrently
+            if not os.path.isdir(d):
+                raise
 
 
 def safe_rm_dir(d):
@@ -216,6 +222,42 @@ class MockSet(object):
         return self.test(item)
 
 
+class LRUCache(object):
+    # Thread-safe mapping that evicts the least recently used keys beyond max_size
+    def __init__(self, max_size=INF):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value = self.data.pop(key)
+            self.data[key] = value
+            return value
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while self.max_size < len(self.data):
+                self.data.popitem(last=False)
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+    def __repr__(self):
+        return '{}({}/{})'.format(self.__class__.__name__, len(self), self.max_size)
+
+
+def hash_content(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
 class HeapElement(object):
     def __init__(self, key, value):
         self.key = key